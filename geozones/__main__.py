@@ -8,11 +8,13 @@ import textwrap
 import click
 import msgpack
 
-from . import http
-from .db import DB
-from .logos import fetch_logos, compress_logos
-from .model import root
-from .tools import info, success, title, ok, error, section, _secho, progress, match_patterns
+from . import cache, http, wiki, wikidump
+from .db import DB, BULK_SIZE
+from .logos import fetch_logos, compress_logos, build_logos_derivatives, LOGOS_CONCURRENCY, LOGOS_RATE
+from .model import root, processors_graph
+from .scheduler import Scheduler, SchedulingError, level_job, processor_job
+from .topology import build_topology, TOPOLOGY_DIR
+from .tools import info, success, title, ok, error, warning, section, _secho, progress, match_patterns
 from . import geojson
 
 # Importing levels modules in order (international first)
@@ -22,6 +24,10 @@ from . import luxembourg  # noqa
 
 DL_DIR = 'downloads'
 DIST_DIR = 'dist'
+# Number of zones fetched at once by distribution cursors
+DIST_BATCH_SIZE = 100
+# Storage-only fields excluded from distributed files
+INTERNALS = {'_vstart': False, '_vend': False}
 CONTEXT_SETTINGS = {
     'help_option_names': ['-?', '--help'],
     'auto_envvar_prefix': 'GEOZONES',
@@ -37,21 +43,87 @@ def merge_exclusions(ctx, exclude):
     return list(set(exclude or []) | set(ctx.obj['exclude'] or []))
 
 
+def run_levels(ctx, step, jobs, *args, **kwargs):
+    '''
+    Execute a step on every selected level and return the results list.
+
+    With more than one job, independent levels are processed concurrently
+    in worker processes following the levels dependencies.
+    '''
+    levels = ctx.obj['levels']
+    if not jobs or jobs <= 1:
+        results = []
+        for level in levels:
+            section('Processing level "{0}"'.format(level.id))
+            results.append(getattr(level, step)(DL_DIR, ctx.obj['db'], *args, **kwargs))
+        return results
+    scheduler = Scheduler(jobs)
+    for level in levels:
+        scheduler.add(level.id, level_job, ctx.obj['mongo'], wiki.configuration(), step, level.id, DL_DIR,
+                      *args, requires=level.dependencies(step), **kwargs)
+    try:
+        return list(scheduler.run().values())
+    except SchedulingError as e:
+        raise click.ClickException(str(e))
+
+
+def run_processors(ctx, step, jobs, only=None, exclude=None, requirements=False, workers=None):
+    '''
+    Execute the processors of a step on every selected level.
+
+    Processors are executed following their dependencies graph:
+    in sequence with a single job, concurrently in worker processes otherwise.
+    `workers` is the size of the process pool parallel processors may use.
+    '''
+    scheduler = Scheduler(jobs or 1)
+    graph = processors_graph(step, ctx.obj['levels'], only, exclude, requirements)
+    config = wiki.configuration()
+    for key, (level, processor, required) in graph.items():
+        scheduler.add(key, processor_job, ctx.obj['mongo'], config, step, level.id, processor.__name__, DL_DIR,
+                      workers, requires=required)
+    try:
+        if jobs and jobs > 1:
+            scheduler.run()
+            return
+        current = None
+        for key in scheduler.order():
+            level, processor, _ = graph[key]
+            if level is not current:
+                section('Processing level "{0}"'.format(level.id))
+                current = level
+            level.run_processor(step, processor.__name__, DL_DIR, ctx.obj['db'], workers)
+    except SchedulingError as e:
+        raise click.ClickException(str(e))
+
+
 @click.group(chain=True, context_settings=CONTEXT_SETTINGS)
 @click.option('-d', '--drop', is_flag=True)
 @click.option('-l', '--level', multiple=True, help='Limits to given levels')
 @click.option('-e', '--exclude', multiple=True, help='Exclude some levels or some functions')
 @click.option('-m', '--mongo', help='MongoDB database', default='localhost')
 @click.option('-H', '--home', help='Specify GeoZones working home')
+@click.option('--sparql-cache', type=click.Choice(cache.MODES), default=cache.ON,
+              help='Wikidata SPARQL responses cache mode')
+@click.option('--sparql-cache-ttl', type=float, default=cache.CACHE_TTL / 3600,
+              help='Wikidata SPARQL responses cache time-to-live in hours')
+@click.option('--wikidata-dump', type=click.Path(exists=True), default=None,
+              help='Extract Wikidata metadata from a dump or a subset instead of SPARQL queries')
+@click.option('--wikidata-dump-workers', type=int, default=None,
+              help='Parse the Wikidata dump with a pool of N processes')
 @click.pass_context
-def cli(ctx, drop, level, exclude, mongo, home):
+def cli(ctx, drop, level, exclude, mongo, home, sparql_cache, sparql_cache_ttl, wikidata_dump,
+        wikidata_dump_workers):
     ctx.obj = {}
     if home:
         os.chdir(home)
     else:
         home = os.getcwd()
     ctx.obj['home'] = home
+    wiki.configure_sparql_cache(home, sparql_cache, sparql_cache_ttl * 3600)
+    if wikidata_dump:
+        wiki.configure_wikidata_dump(os.path.abspath(wikidata_dump), wikidata_dump_workers)
     ctx.obj['exclude'] = exclude
+    ctx.obj['mongo'] = mongo
 
     levels = []
     for l in root.traverse():
@@ -67,6 +139,7 @@ def cli(ctx, drop, level, exclude, mongo, home):
     if drop:
         with ok('Droping existing collection'):
             db.drop()
+            db.manifest.drop()
 
     db.initialize()
 
@@ -129,8 +202,10 @@ def sourceslist(ctx):
 @cli.command()
 @click.pass_context
 @click.option('-o', '--only', default=None, help='Only execute a given function')
+@click.option('-r', '--requirements', is_flag=True, help='Also execute the requirements of the `--only` function')
 @click.option('-e', '--exclude', multiple=True, help='Exclude some functions')
-def preprocess(ctx, only, exclude):
+@click.option('-j', '--jobs', type=int, default=None, help='Run independent processors with N processes')
+def preprocess(ctx, only, requirements, exclude, jobs):
     '''
     Perform pre-processing.
 
@@ -138,11 +213,9 @@ def preprocess(ctx, only, exclude):
     option will reduce the duration to 3 minutes.
     '''
     title(textwrap.dedent(preprocess.__doc__))
-    zones = ctx.obj['db']
     exclude = merge_exclusions(ctx, exclude)
 
-    for level in ctx.obj['levels']:
-        level.preprocess(DL_DIR, zones, only, exclude)
+    run_processors(ctx, 'preprocess', jobs, only, exclude, requirements)
 
     success('Pre-processing done')
 
@@ -151,7 +224,14 @@ def preprocess(ctx, only, exclude):
 @click.pass_context
 @click.option('-o', '--only', default=None, help='Only execute a given function')
 @click.option('-e', '--exclude', multiple=True, help='Exclude some functions')
-def load(ctx, only, exclude):
+@click.option('-b', '--batch-size', default=BULK_SIZE, help='Number of zones written per bulk write')
+@click.option('-w', '--workers', type=int, default=None,
+              help='Process geometries with a pool of N processes')
+@click.option('-a', '--arrow', is_flag=True, help='Read datasets with pyogrio (requires the arrow extra)')
+@click.option('-j', '--jobs', type=int, default=None, help='Load independent levels with N processes')
+@click.option('-f', '--force', is_flag=True, help='Reload datasets even if unchanged')
+@click.option('-r', '--resume', is_flag=True, help='Resume interrupted datasets loads from their last checkpoint')
+def load(ctx, only, exclude, batch_size, workers, arrow, jobs, force, resume):
     '''
     Load zones from a folder of zip files containing shapefiles
 
@@ -162,19 +242,21 @@ def load(ctx, only, exclude):
     '''
     title(textwrap.dedent(load.__doc__))
     exclude = merge_exclusions(ctx, exclude)
-    zones = ctx.obj['db']
-    total = 0
 
-    for level in ctx.obj['levels']:
-        section('Processing level "{0}"'.format(level.id))
-        total += level.load(DL_DIR, zones, only, exclude)
+    total = sum(run_levels(ctx, 'load', jobs, only, exclude,
+                           batch_size=batch_size, workers=workers, arrow=arrow,
+                           force=force, resume=resume))
 
     success('Done: Loaded {0} zones'.format(total))
 
 
 @cli.command()
 @click.pass_context
-def aggregate(ctx):
+@click.option('-w', '--workers', type=int, default=None,
+              help='Union geometries with a pool of N processes')
+@click.option('-g', '--grid-size', type=float, default=None,
+              help='Snap aggregated geometries on a precision grid')
+def aggregate(ctx, workers, grid_size):
     '''
     Perform zones aggregations.
     '''
@@ -184,34 +266,59 @@ def aggregate(ctx):
     total = 0
 
     for level in reversed(ctx.obj['levels']):
-        total += level.build_aggregates(zones)
+        total += level.build_aggregates(zones, workers=workers, grid_size=grid_size)
 
     success('Done: Built {0} zones by aggregation'.format(total))
 
 
+@cli.command('wikidump')
+@click.pass_context
+@click.argument('dump', type=click.Path(exists=True))
+@click.option('-o', '--output', default=os.path.join(cache.CACHE_DIR, 'wikidata.jsonl.gz'),
+              help='Subset filename')
+@click.option('-w', '--workers', type=int, default=None,
+              help='Parse the dump with a pool of N processes')
+def wikidump_subset(ctx, dump, output, workers):
+    '''
+    Extract a Wikidata subset from a JSON dump.
+
+    Only the entities and properties used by Wikidata enrichment are kept
+    and the subset is used by the following commands.
+    '''
+    title(textwrap.dedent(wikidump_subset.__doc__))
+    dirname = os.path.dirname(output)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    ids = [id for id in ctx.obj['db'].distinct('wikidata') if id]
+    total = wikidump.build_subset(dump, output, ids, workers)
+    wiki.configure_wikidata_dump(os.path.abspath(output), workers)
+    success('Extracted {0} Wikidata entities into {1}'.format(total, output))
+
+
 @cli.command()
 @click.pass_context
 @click.option('-o', '--only', default=None, help='Only execute a given function')
+@click.option('-r', '--requirements', is_flag=True, help='Also execute the requirements of the `--only` function')
 @click.option('-e', '--exclude', multiple=True, help='Exclude some functions')
-def postprocess(ctx, only, exclude):
+@click.option('-j', '--jobs', type=int, default=None, help='Run independent processors with N processes')
+@click.option('-w', '--workers', type=int, default=None,
+              help='Build geometries with a pool of N processes (ex: EPCIs ones)')
+def postprocess(ctx, only, requirements, exclude, jobs, workers):
     '''
     Perform post-processing.
 
     Take between 2 hours and 6 hours.
 
-    Take care of the order, especially `process_insee_cog` and
-    `compute_region_population` might need to be run again with
-    the `-o` option.
+    Processors are run after the ones providing what they require,
+    the `-r` option makes the `-o` one also run the required processors.
 
     Excluding `fetch_missing_data_from_dbpedia` with the `-e`
     option will reduce the duration to 3 minutes.
     '''
     title(textwrap.dedent(postprocess.__doc__))
-    zones = ctx.obj['db']
     exclude = merge_exclusions(ctx, exclude)
 
-    for level in ctx.obj['levels']:
-        level.postprocess(DL_DIR, zones, only, exclude)
+    run_processors(ctx, 'postprocess', jobs, only, exclude, requirements, workers)
 
     success('Post-processing done')
 
@@ -225,7 +332,8 @@ def postprocess(ctx, only, exclude):
 @click.option('-r', '--serialization', default='json',
               type=click.Choice(['json', 'msgpack']))
 @click.option('-k', '--keys', default=None)
-def dist(ctx, name, pretty, split, compress, serialization, keys):
+@click.option('-b', '--batch-size', default=DIST_BATCH_SIZE, help='Number of zones fetched at once')
+def dist(ctx, name, pretty, split, compress, serialization, keys, batch_size):
     '''Dump a distributable file'''
     keys = keys and keys.split(',')
     title('Dumping data to {serialization} with keys {keys}'.format(
@@ -244,7 +352,8 @@ def dist(ctx, name, pretty, split, compress, serialization, keys):
             filename = 'zones-{level}.{serialization}'.format(
                 level=level_id.replace(':', '-'), serialization=serialization)
             with ok('Generating {filename}'.format(filename=filename)):
-                zones = geozones.find({'level': level_id, 'code': {'$exists': True}})
+                zones = geozones.find({'level': level_id, 'code': {'$exists': True}}, INTERNALS)
+                zones = zones.batch_size(batch_size)
                 if serialization == 'json':
                     with open(filename, 'w') as out:
                         geojson.dump(zones, out, pretty=pretty, keys=keys)
@@ -257,7 +366,8 @@ def dist(ctx, name, pretty, split, compress, serialization, keys):
     else:
         filename = 'zones.{serialization}'.format(serialization=serialization)
         with ok('Generating {filename}'.format(filename=filename)):
-            zones = geozones.find({'level': {'$in': level_ids}, 'code': {'$exists': True}})
+            zones = geozones.find({'level': {'$in': level_ids}, 'code': {'$exists': True}}, INTERNALS)
+            zones = zones.batch_size(batch_size)
             if serialization == 'json':
                 with open(filename, 'w') as out:
                     geojson.dump(zones, out, pretty=pretty, keys=keys)
@@ -316,7 +426,13 @@ def dist(ctx, name, pretty, split, compress, serialization, keys):
 @click.option('-r', '--serialization', default='json',
               type=click.Choice(['json', 'msgpack']))
 @click.option('-k', '--keys', default=None)
-def full(ctx, pretty, split, compress, serialization, keys):
+@click.option('-w', '--workers', type=int, default=None,
+              help='Process geometries with a pool of N processes')
+@click.option('-j', '--jobs', type=int, default=None, help='Run independent levels and processors with N processes')
+@click.option('-a', '--arrow', is_flag=True, help='Read datasets with pyogrio (requires the arrow extra)')
+@click.option('-g', '--grid-size', type=float, default=None,
+              help='Snap aggregated geometries on a precision grid')
+def full(ctx, pretty, split, compress, serialization, keys, workers, jobs, arrow, grid_size):
     '''
     Perfom full processing, execute all operations from download to dist.
 
@@ -324,10 +440,10 @@ def full(ctx, pretty, split, compress, serialization, keys):
     '''
     title(textwrap.dedent(full.__doc__))
     ctx.invoke(download)
-    ctx.invoke(preprocess)
-    ctx.invoke(load)
-    ctx.invoke(aggregate)
-    ctx.invoke(postprocess)
+    ctx.invoke(preprocess, jobs=jobs)
+    ctx.invoke(load, workers=workers, arrow=arrow, jobs=jobs)
+    ctx.invoke(aggregate, workers=workers, grid_size=grid_size)
+    ctx.invoke(postprocess, jobs=jobs, workers=workers)
     ctx.invoke(dist, pretty=pretty, split=split, compress=compress,
                serialization=serialization, keys=keys)
 
@@ -335,15 +451,49 @@ def full(ctx, pretty, split, compress, serialization, keys):
 @cli.command()
 @click.pass_context
 @click.option('-c/-nc', '--compress/--no-compress', default=False)
-def logos(ctx, compress):
+@click.option('-n', '--concurrency', type=int, default=LOGOS_CONCURRENCY, help='Number of concurrent downloads')
+@click.option('-r', '--rate', type=float, default=LOGOS_RATE, help='Maximum number of requests by second by host')
+@click.option('-D', '--derivatives', is_flag=True, help='Build thumbnails and minified SVGs')
+@click.option('-w', '--workers', type=int, default=None, help='Build derivatives with a pool of N processes')
+def logos(ctx, compress, concurrency, rate, derivatives, workers):
     '''Fetch logos from data'''
     title(logos.__doc__)
     zones = ctx.obj['db']
-    fetch_logos(zones, DIST_DIR)
+    fetch_logos(zones, DIST_DIR, concurrency=concurrency, rate=rate)
+    if derivatives:
+        build_logos_derivatives(zones, DIST_DIR, workers)
     if compress:
         compress_logos(DIST_DIR)
 
 
+@cli.command()
+@click.pass_context
+@click.option('-a', '--at', default=DB.TODAY, help='Build topologies for zones valid at this date')
+def topology(ctx, at):
+    '''
+    Build shared arcs topologies.
+
+    Topologies are used to dissolve zones when aggregating.
+    '''
+    title(textwrap.dedent(topology.__doc__))
+    zones = ctx.obj['db']
+    for level in ctx.obj['levels']:
+        with ok('Building topology for level "{0}"'.format(level.id)):
+            built = build_topology(zones, level.id, at)
+        info('{0} zones sharing {1} arcs', len(built.zones), len(built.arcs))
+    success('Topologies stored in {0}', TOPOLOGY_DIR)
+
+
+@cli.command()
+@click.pass_context
+def migrate(ctx):
+    '''Migrate an existing database to the current storage model'''
+    title(migrate.__doc__)
+    zones = ctx.obj['db']
+    count = zones.migrate_validity_bounds()
+    success('Done: Migrated validity boundaries of {0} zones', count)
+
+
 @cli.command()
 @click.pass_context
 def status(ctx):
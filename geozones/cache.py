@@ -0,0 +1,114 @@
+'''
+Persistent responses cache
+
+Responses are stored as compressed JSON in a SQLite database
+and are addressed by a hash of their request.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+from contextlib import closing, contextmanager
+
+# Cache modes
+ON = 'on'  # Use fresh entries and store new responses
+READONLY = 'readonly'  # Use any stored entry, never perform requests
+REFRESH = 'refresh'  # Ignore stored entries but store new responses
+OFF = 'off'
+MODES = (ON, READONLY, REFRESH, OFF)
+
+CACHE_DIR = 'cache'
+CACHE_TTL = 7 * 24 * 3600  # One week in seconds
+CACHE_SIZE = 256 * 2 ** 20  # Maximum size of stored responses in bytes
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+)
+'''
+
+
+class ResponseCache(object):
+    '''
+    A content-addressed responses cache with a TTL and a size-based eviction.
+
+    A connection is opened for each operation so the cache
+    can be used from many threads and processes.
+    '''
+    def __init__(self, filename, mode=ON, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        if mode not in MODES:
+            raise ValueError('Unknown cache mode "{0}"'.format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.ttl = ttl
+        self.max_size = max_size
+        if mode != OFF:
+            dirname = os.path.dirname(filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            with self._connect() as connection:
+                connection.execute(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        '''Open a connection whose transaction is committed (or rolled back) then closed'''
+        with closing(sqlite3.connect(self.filename, timeout=30)) as connection, connection:
+            yield connection
+
+    @staticmethod
+    def key(*parts):
+        '''Compute the key of a request given its parts'''
+        sha = hashlib.sha256()
+        for part in parts:
+            sha.update(part.encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    @property
+    def offline(self):
+        '''Wether requests should never be performed'''
+        return self.mode == READONLY
+
+    def get(self, key):
+        '''Get a stored response or `None`'''
+        if self.mode in (OFF, REFRESH):
+            return None
+        query = 'SELECT data FROM responses WHERE key = ?'
+        params = [key]
+        if self.mode == ON:
+            query += ' AND created > ?'
+            params.append(time.time() - self.ttl)
+        with self._connect() as connection:
+            row = connection.execute(query, params).fetchone()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8')) if row else None
+
+    def set(self, key, response):
+        '''Store a response and evict the oldest ones if the cache is too big'''
+        if self.mode in (OFF, READONLY):
+            return
+        data = zlib.compress(json.dumps(response, separators=(',', ':')).encode('utf-8'))
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                               (key, time.time(), len(data), data))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        excess = total - self.max_size
+        for key, size in connection.execute('SELECT key, size FROM responses ORDER BY created').fetchall():
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM responses')
@@ -1,14 +1,118 @@
+import copy
+
+from bisect import bisect_right
 from datetime import date
 
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, ReplaceOne, UpdateOne
 from pymongo.collection import Collection
 from pymongo.errors import BulkWriteError
 
-from .tools import error, progress
+from .tools import error, warning, progress
 
 DB_NAME = 'geozones'
+MANIFEST_NAME = 'manifest'
 TODAY = date.today().isoformat()
 
+# Number of operations sent in a single bulk write
+BULK_SIZE = 1000
+
+# Boundaries used for zones without validity start or end
+VALIDITY_START = '0001-01-01'
+VALIDITY_END = '9999-12-31'
+
+# Collection methods invalidating the in-memory zones indexes
+WRITE_METHODS = (
+    'bulk_write', 'insert_one', 'insert_many', 'safe_bulk_insert',
+    'replace_one', 'update_one', 'update_many', 'update_zone', 'update_zones',
+    'find_one_and_replace', 'find_one_and_update', 'find_one_and_delete',
+    'delete_one', 'delete_many',
+)
+
+
+def validity_bounds(zone):
+    '''Get a zone validity `(start, end)` boundaries with open ends replaced by sentinels'''
+    validity = zone.get('validity') or {}
+    return validity.get('start') or VALIDITY_START, validity.get('end') or VALIDITY_END
+
+
+def with_validity_bounds(zone):
+    '''
+    Denormalize a zone validity into the indexed `_vstart` and `_vend` fields.
+
+    Those fields are required by validity queries (see `DB._valid_at()`).
+    '''
+    zone['_vstart'], zone['_vend'] = validity_bounds(zone)
+    return zone
+
+
+def _bulk_errors(e):
+    '''Format a `BulkWriteError` write errors for display'''
+    return '\n\t'.join(
+        # brackets in errors needs to be escaped because of
+        # the  underlying `.format()` call in `error()`
+        err['errmsg'].replace('{', '{{').replace('}', '}}')
+        for err in e.details['writeErrors']
+    )
+
+
+class BulkWriter(object):
+    '''
+    Buffer write operations and send them as unordered bulk writes.
+
+    Operations are flushed every `batch_size` operations
+    and when leaving the context manager.
+    `written` holds the exact number of successful operations.
+    '''
+    def __init__(self, collection, batch_size=BULK_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.operations = []
+        self.keys = set()
+        self.written = 0
+        self.batches = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def write(self, operation, key=None):
+        '''
+        Queue a write operation.
+
+        Operations sharing the same `key` are never sent in the same batch
+        because unordered bulk writes do not guarantee their ordering.
+        '''
+        if key is not None:
+            if key in self.keys:
+                self.flush()
+            self.keys.add(key)
+        self.operations.append(operation)
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def replace(self, doc):
+        '''Queue an upsert of a full document'''
+        self.write(ReplaceOne({'_id': doc['_id']}, doc, upsert=True), doc['_id'])
+
+    def flush(self):
+        '''Send the pending operations and returns the number of successful ones'''
+        if not self.operations:
+            return 0
+        operations, self.operations, self.keys = self.operations, [], set()
+        self.batches += 1
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+            done = len(operations)
+        except BulkWriteError as e:
+            done = len(operations) - len(e.details['writeErrors'])
+            msg = 'Batch {0}: {1}/{2} operations failed'.format(
+                self.batches, len(operations) - done, len(operations))
+            error(':\n\t'.join((msg, _bulk_errors(e))))
+        self.written += done
+        return done
+
 
 class DB(Collection):
     TODAY = TODAY
@@ -17,11 +121,14 @@ class DB(Collection):
         client = MongoClient(url)
         db = client[DB_NAME]
         super().__init__(db, 'geozones')
+        self.manifest = Manifest(db[MANIFEST_NAME])
 
     def initialize(self):
         '''Initialize indexes'''
         # If index already exists it will not be recreated
         self.create_index([('level', ASCENDING), ('code', ASCENDING)])
+        self.create_index([('level', ASCENDING), ('code', ASCENDING),
+                           ('_vstart', ASCENDING), ('_vend', ASCENDING)])
         self.create_index([('level', ASCENDING), ('keys', ASCENDING)])
         self.create_index('parents')
 
@@ -30,36 +137,41 @@ class DB(Collection):
         Try to insert in bulk and returns the number of insertions.
         '''
         try:
-            result = self.insert_many(data)
+            result = self.insert_many(with_validity_bounds(zone) for zone in data)
             return len(result.inserted_ids)
         except BulkWriteError as e:
-            messages = '\n\t'.join(
-                # brackets in errors needs to be escaped because of
-                # the  underlying `.format()` call in `error()`
-                err['errmsg'].replace('{', '{{').replace('}', '}}')
-                for err in e._OperationFailure__details['writeErrors']
-            )
-            error(':\n\t'.join((str(e), messages)))
+            error(':\n\t'.join((str(e), _bulk_errors(e))))
+            return e.details['nInserted']
 
-            return e._OperationFailure__details['nInserted']
+    def bulk_writer(self, batch_size=BULK_SIZE):
+        '''Get a buffered bulk writer on this collection'''
+        return BulkWriter(self, batch_size)
 
     def _valid_at(self, at=None):
-        '''Build a validity query for a given date'''
+        '''
+        Build a validity query for a given date.
+
+        Open validity boundaries are stored as sentinel dates
+        so a single range predicate covers every case.
+        '''
         if at is None:
             return {}
         if isinstance(at, date):
-            at = date.isoformat()
-        return {'$or': [
-            # Zones without validity boundings, ie. valid anytime
-            {'validity': None},
-            {'validity.start': None, 'validity.end': None},
-            # Ended zones with matching validity boundings
-            {'validity.start': {'$lte': at}, 'validity.end': {'$gt': at}},
-            # Not ended zones with matching validity start bounding
-            {'validity.start': {'$lte': at}, 'validity.end': None},
-            # Ended zones with undefined start and matching validity end bounding
-            {'validity.start': None, 'validity.end': {'$gt': at}},
-        ]}
+            at = at.isoformat()
+        return {'_vstart': {'$lte': at}, '_vend': {'$gt': at}}
+
+    def migrate_validity_bounds(self, batch_size=BULK_SIZE):
+        '''
+        Write the denormalized validity boundaries of existing zones.
+
+        Returns the number of updated zones.
+        '''
+        query = {'_vstart': {'$exists': False}}
+        with self.bulk_writer(batch_size) as writer:
+            for zone in progress(self.find(query, {'validity': True}), length=self.count_documents(query)):
+                start, end = validity_bounds(zone)
+                writer.write(UpdateOne({'_id': zone['_id']}, {'$set': {'_vstart': start, '_vend': end}}))
+        return writer.written
 
     def zone(self, level, code, at=None, **kwargs):
         '''Get a Zone given its level, its code and a date'''
@@ -79,12 +191,59 @@ class DB(Collection):
         query.update(level=level, code=code)
         return self.update_many(query, ops)
 
+    def codes(self, level, at=None):
+        '''
+        Get a `{code: identifier}` lookup table of a level zones valid at a given date.
+
+        When many zones share a code, the first one is kept as `zone()` does.
+        '''
+        query = self._valid_at(at)
+        query.update(level=level)
+        codes = {}
+        for zone in self.find(query, {'code': True}):
+            codes.setdefault(zone['code'], zone['_id'])
+        return codes
+
     def level(self, level, at=None, **kwargs):
         '''Get all Zones for a given level and a date'''
         query = self._valid_at(at)
         query.update(level=level, **kwargs)
         return self.find(query)
 
+    def attach_parents(self, level, parent_level, ops=None, missing='Parent zone {0} not found for: {1}',
+                       batch_size=BULK_SIZE):
+        '''
+        Attach the zones of a level to the parents of their `parent_level` parent zone.
+
+        The parent zone is the first zone of `parent_level` in each zone parents.
+        Parent zones are preloaded with a single query and updates are sent in bulk.
+        `ops(zone, parent)` may provide extra update operators for each zone.
+        The `missing` warning is formatted with the parent and the zone identifiers
+        for each zone whose parent is not found.
+        Returns the number of updated zones.
+        '''
+        prefix = parent_level + ':'
+        zones = []
+        for zone in self.find({'level': level}, {'geom': False}):
+            candidates = [p for p in zone.get('parents', []) if p.startswith(prefix)]
+            if not candidates:
+                warning('No parent candidate found for: {0}', zone['_id'])
+                continue
+            zones.append((zone, candidates[0]))
+        ids = list(set(parent_id for _, parent_id in zones))
+        parents = dict((p['_id'], p) for p in self.find({'_id': {'$in': ids}}, {'geom': False}))
+        with self.bulk_writer(batch_size) as writer:
+            for zone, parent_id in zones:
+                parent = parents.get(parent_id)
+                if not parent:
+                    warning(missing, parent_id, zone['_id'])
+                    continue
+                update = {'$addToSet': {'parents': {'$each': parent.get('parents', [])}}}
+                if ops:
+                    update.update(ops(zone, parent))
+                writer.write(UpdateOne({'_id': zone['_id']}, update))
+        return writer.written
+
     def aggregate_with_progress(self, pipeline, msg=None):
         '''
         Iter over the result of an aggregation and display a progress bar.
@@ -98,3 +257,174 @@ class DB(Collection):
 
         for item in progress(self.aggregate(pipeline), msg=msg, length=total):
             yield item
+
+
+class Manifest(object):
+    '''
+    Keep track of the loaded datasets fingerprints.
+
+    Each entry is identified by a `(level, extractor, filename)` triplet
+    and stores the file SHA-256, size and modification time
+    as well as the extractor source code SHA-256.
+    The modification time is only a shortcut to avoid hashing unchanged files,
+    it is not part of the comparison.
+    '''
+    FIELDS = ('sha256', 'size', 'source')
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def key(self, level, extractor, filename):
+        return ':'.join((level, extractor, filename))
+
+    def get(self, level, extractor, filename):
+        '''Get the recorded entry for a dataset if any'''
+        return self.collection.find_one({'_id': self.key(level, extractor, filename)})
+
+    def is_current(self, entry, fingerprint):
+        '''Wether a recorded entry matches a given fingerprint'''
+        return bool(entry) and all(entry.get(f) == fingerprint.get(f) for f in self.FIELDS)
+
+    def record(self, level, extractor, filename, fingerprint, loaded, on=None):
+        '''Record a loaded dataset fingerprint'''
+        entry = dict(fingerprint, level=level, extractor=extractor, filename=filename,
+                     loaded=loaded, date=on or date.today().isoformat())
+        self.collection.replace_one({'_id': self.key(level, extractor, filename)}, entry, upsert=True)
+
+    def checkpoint(self, level, extractor, filename, fingerprint, offset, loaded):
+        '''
+        Save a dataset loading checkpoint.
+
+        The previous load entry is kept until the dataset is fully loaded
+        so an interrupted load is never considered as current.
+        '''
+        checkpoint = dict(fingerprint, offset=offset, loaded=loaded, date=date.today().isoformat())
+        self.collection.update_one({'_id': self.key(level, extractor, filename)},
+                                   {'$set': {'checkpoint': checkpoint}}, upsert=True)
+
+    def drop(self):
+        self.collection.drop()
+
+
+class ZoneIndex(object):
+    '''
+    An in-memory temporal index of a level zones.
+
+    Zones are loaded once without their geometry and indexed
+    by code and by keys with their validity intervals sorted by start.
+    '''
+    def __init__(self, db, level):
+        self.level = level
+        self.zones = {}
+        self.codes = {}
+        self.keys = {}
+        for zone in db.find({'level': level}, {'geom': False}):
+            self._add(zone)
+        for entries in self.codes.values():
+            entries.sort()
+        for entries in self.keys.values():
+            entries.sort()
+
+    def __len__(self):
+        return len(self.zones)
+
+    def _entries(self, zone):
+        '''Iter over all `(index, key)` a zone should be indexed by'''
+        yield self.codes, zone['code']
+        for name, values in (zone.get('keys') or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                yield self.keys, (name, value)
+
+    def _add(self, zone):
+        self.zones[zone['_id']] = zone
+        start, end = validity_bounds(zone)
+        for index, key in self._entries(zone):
+            index.setdefault(key, []).append((start, end, zone['_id']))
+
+    def _remove(self, zone_id):
+        zone = self.zones.pop(zone_id, None)
+        if not zone:
+            return
+        for index, key in self._entries(zone):
+            index[key] = [e for e in index.get(key, []) if e[2] != zone_id]
+
+    def refresh(self, zone):
+        '''Replace or add a zone into the index'''
+        self._remove(zone['_id'])
+        zone = {k: v for k, v in zone.items() if k != 'geom'}
+        self._add(copy.deepcopy(zone))
+        for index, key in self._entries(zone):
+            index[key].sort()
+
+    def _lookup(self, entries, at=None):
+        '''Find the identifiers of the zones valid at a given date'''
+        if at is None:
+            return [zone_id for _, _, zone_id in entries]
+        if isinstance(at, date):
+            at = at.isoformat()
+        idx = bisect_right(entries, (at, VALIDITY_END + '~'))
+        return [zone_id for start, end, zone_id in reversed(entries[:idx]) if end > at]
+
+    def zone(self, code, at=None):
+        '''Get a zone copy given its code and a date'''
+        zone_id = self.zone_id(code, at)
+        return copy.deepcopy(self.zones[zone_id]) if zone_id else None
+
+    def zone_id(self, code, at=None):
+        '''Get a zone identifier given its code and a date'''
+        ids = self._lookup(self.codes.get(code, []), at)
+        return ids[0] if ids else None
+
+    def find(self, name, value, at=None):
+        '''Get all zones copies having a given key value at a given date'''
+        if name == 'code':
+            entries = self.codes.get(value, [])
+        else:
+            entries = self.keys.get((name, value), [])
+        return [copy.deepcopy(self.zones[zone_id]) for zone_id in self._lookup(entries, at)]
+
+
+class IndexedDB(object):
+    '''
+    Wraps a `DB` to serve zones lookups of some levels from `ZoneIndex`.
+
+    Indexes are lazily loaded on first lookup and dropped
+    on any write performed through this wrapper.
+    Any other call is forwarded to the wrapped `DB`.
+    '''
+    def __init__(self, db, levels):
+        self.db = db
+        self.levels = set(levels)
+        self.indexes = {}
+
+    def __getattr__(self, name):
+        if name in WRITE_METHODS:
+            self.indexes.clear()
+        return getattr(self.db, name)
+
+    def index(self, level):
+        if level not in self.indexes:
+            self.indexes[level] = ZoneIndex(self.db, level)
+        return self.indexes[level]
+
+    def refresh(self, zone):
+        '''Update a written zone into its level index if loaded'''
+        if zone.get('level') in self.indexes:
+            self.indexes[zone['level']].refresh(zone)
+
+    def zone(self, level, code, at=None, **kwargs):
+        '''Get a Zone given its level, its code and a date'''
+        if level not in self.levels or kwargs:
+            return self.db.zone(level, code, at, **kwargs)
+        return self.index(level).zone(code, at)
+
+    def level(self, level, at=None, **kwargs):
+        '''Get all Zones for a given level and a date'''
+        if level in self.levels and len(kwargs) == 1:
+            (name, value), = kwargs.items()
+            if (name == 'code' or name.startswith('keys.')) and isinstance(value, str):
+                name = name.replace('keys.', '', 1)
+                return iter(self.index(level).find(name, value, at))
+        return self.db.level(level, at, **kwargs)
@@ -57,7 +57,7 @@ def extract_overseas_collectivities(db, polygon):
 
 
 @departement.extractor('https://www.data.gouv.fr/s/resources/contours-des-departements-francais-issus-d-openstreetmap/'
-                       '20170614-200948/departements-20170102-simplified.zip')
+                       '20170614-200948/departements-20170102-simplified.zip', index=True)
 def extract_2017_french_departement(db, polygon):
     '''
     Extract a french departement informations from a MultiPolygon.
@@ -77,20 +77,20 @@ def extract_2017_french_departement(db, polygon):
     return zone
 
 @departement.extractor(contours_etalab(2018, 'departements', '100m'),
-                       filename='departements-100m-2018.geojson.gz')
+                       filename='departements-100m-2018.geojson.gz', index=True)
 def extract_2018_french_departements(db, polygon):
     props = polygon['properties']
     return db.zone(departement.id, props['code'].lower(), '2018-01-01')
 
 
 @departement.extractor(contours_etalab(2019, 'departements', '100m'),
-                       filename='departements-100m-2019.geojson.gz')
+                       filename='departements-100m-2019.geojson.gz', index=True)
 def extract_2019_french_departements(db, polygon):
     props = polygon['properties']
     return db.zone(departement.id, props['code'].lower(), '2019-01-01')
 
 
-@region.extractor(openfla('regions-20140306-100m'))
+@region.extractor(openfla('regions-20140306-100m'), index=True)
 def extract_2014_french_region(db, polygon):
     '''
     Extract a french region informations from a MultiPolygon.
@@ -107,7 +107,7 @@ def extract_2014_french_region(db, polygon):
     return zone
 
 
-@region.extractor(openfla('regions-20161121'), simplify=0.01)
+@region.extractor(openfla('regions-20161121'), simplify=0.01, index=True)
 def extract_2016_french_region(db, polygon):
     '''
     Extract new french region informations from a MultiPolygon.
@@ -124,7 +124,7 @@ def extract_2016_french_region(db, polygon):
     return zone
 
 
-@region.extractor(openfla('regions-20170102'), simplify=0.01)
+@region.extractor(openfla('regions-20170102'), simplify=0.01, index=True)
 def extract_2017_french_region(db, polygon):
     '''
     Extract new french region informations from a MultiPolygon.
@@ -142,20 +142,20 @@ def extract_2017_french_region(db, polygon):
 
 
 @region.extractor(contours_etalab(2018, 'regions', '100m'),
-                  filename='regions-100m-2018.geojson.gz')
+                  filename='regions-100m-2018.geojson.gz', index=True)
 def extract_2018_french_regions(db, polygon):
     props = polygon['properties']
     return db.zone(region.id, props['code'], '2018-01-01')
 
 
 @region.extractor(contours_etalab(2019, 'regions', '100m'),
-                  filename='regions-100m-2019.geojson.gz')
+                  filename='regions-100m-2019.geojson.gz', index=True)
 def extract_2019_french_regions(db, polygon):
     props = polygon['properties']
     return db.zone(region.id, props['code'], '2019-01-01')
 
 
-@commune.extractor(openfla('communes-20131220-100m'))
+@commune.extractor(openfla('communes-20131220-100m'), index=True)
 def extract_2014_french_commune(db, polygon):
     '''
     Extract a french town informations from a MultiPolygon.
@@ -172,7 +172,7 @@ def extract_2014_french_commune(db, polygon):
     return zone
 
 
-@commune.extractor(openfla('communes-20150101-100m'))
+@commune.extractor(openfla('communes-20150101-100m'), index=True)
 def extract_2015_french_commune(db, polygon):
     '''
     Extract a french town informations from a MultiPolygon.
@@ -189,7 +189,7 @@ def extract_2015_french_commune(db, polygon):
     return zone
 
 
-@commune.extractor(openfla('communes-20160119'), simplify=0.0005)
+@commune.extractor(openfla('communes-20160119'), simplify=0.0005, index=True)
 def extract_2016_french_commune(db, polygon):
     '''
     Extract a french town informations from a MultiPolygon.
@@ -206,7 +206,7 @@ def extract_2016_french_commune(db, polygon):
     return zone
 
 
-@commune.extractor(openfla('communes-20170111'), simplify=0.0005)
+@commune.extractor(openfla('communes-20170111'), simplify=0.0005, index=True)
 def extract_2017_french_commune(db, polygon):
     '''
     Extract a french town informations from a MultiPolygon.
@@ -226,7 +226,7 @@ def extract_2017_french_commune(db, polygon):
 
 
 @commune.extractor(contours_etalab(2018, 'communes', '100m'),
-                   filename='communes-100m-2018.geojson.gz')
+                   filename='communes-100m-2018.geojson.gz', index=True)
 def extract_2018_french_commune(db, polygon):
     '''
     Extract a french town informations from a MultiPolygon.
@@ -242,7 +242,7 @@ def extract_2018_french_commune(db, polygon):
 
 
 @commune.extractor(contours_etalab(2019, 'communes', '100m'),
-                   filename='communes-100m-2019.geojson.gz')
+                   filename='communes-100m-2019.geojson.gz', index=True)
 def extract_2019_french_commune(db, polygon):
     '''
     Extract a french town informations from a MultiPolygon.
@@ -280,20 +280,20 @@ def extract_french_arrondissements(db, polygon):
     }
 
 @epci.extractor(contours_etalab(2018, 'epci', '100m'),
-                filename='epci-100m-2018.geojson.gz')
+                filename='epci-100m-2018.geojson.gz', index=True)
 def extract_2018_french_epcis(db, polygon):
     props = polygon['properties']
     return db.zone(epci.id, props['code'], '2018-01-01')
 
 
 @epci.extractor(contours_etalab(2019, 'epci', '100m'),
-                filename='epci-100m-2019.geojson.gz')
+                filename='epci-100m-2019.geojson.gz', index=True)
 def extract_2019_french_epcis(db, polygon):
     props = polygon['properties']
     return db.zone(epci.id, props['code'], '2019-01-01')
 
 
-@canton.extractor(openfla('cantons-2015'), simplify=0.005)
+@canton.extractor(openfla('cantons-2015'), simplify=0.005, index=[departement])
 def extract_french_canton(db, polygon):
     '''
     Extract a french canton informations from a MultiPolygon.
@@ -322,26 +322,34 @@ def extract_french_canton(db, polygon):
 
 
 @iris.extractor('https://www.data.gouv.fr/s/resources/contour-des-iris-insee-tout-en-un/'
-                '20150428-161348/iris-2013-01-01.zip')
-def extract_iris(db, polygon):
+                '20150428-161348/iris-2013-01-01.zip', index=[commune], batch=True,
+                columns=['DCOMIRIS', 'DEPCOM', 'NOM_IRIS', 'TYP_IRIS'])
+def extract_iris(db, polygons):
     '''
     Extract French IrisBased on data from:
     http://professionnels.ign.fr/contoursiris
-    '''
-    props = polygon['properties']
-    code = props['DCOMIRIS']
-    parents = ['country:fr', 'country-group:ue', 'country-group:world']
-    com = db.zone(commune.id, props['DEPCOM'], '2013-01-01')
-    if com:
-        parents.append(com['_id'])
-    name = props['NOM_IRIS'].title()
-    return {
-        'code': code,
-        'name': name,
-        'parents': parents,
-        '_type': props['TYP_IRIS'],
-        'keys': {
-            'iris': code
-        },
 
-    }
+    Towns are resolved once for each batch of polygons.
+    '''
+    towns = db.index(commune.id)
+    towns_ids = dict(
+        (code, towns.zone_id(code, '2013-01-01'))
+        for code in set(polygon['properties']['DEPCOM'] for polygon in polygons)
+    )
+    zones = []
+    for polygon in polygons:
+        props = polygon['properties']
+        code = props['DCOMIRIS']
+        parents = ['country:fr', 'country-group:ue', 'country-group:world']
+        if towns_ids[props['DEPCOM']]:
+            parents.append(towns_ids[props['DEPCOM']])
+        zones.append({
+            'code': code,
+            'name': props['NOM_IRIS'].title(),
+            'parents': parents,
+            '_type': props['TYP_IRIS'],
+            'keys': {
+                'iris': code
+            },
+        })
+    return zones
@@ -59,7 +59,7 @@ country_subset.aggregate(
     wikidata='Q212429'
 )
 
-country_subset.aggregate(
+drom = country_subset.aggregate(
     'fr:drom', 'DROM',
     lambda db: [zone['_id'] for zone in droms(db)],
     parents=['country:fr', 'country-group:ue', 'country-group:world'],
@@ -70,7 +70,7 @@ country_subset.aggregate(
 country_subset.aggregate(
     'fr:dromcom', 'DROM-COM',
     lambda db: (
-        [zone['_id'] for zone in droms(db)] +
+        [drom] +
         [zone['_id'] for zone in db.level(collectivite.id, TODAY)]
     ),
     parents=['country:fr', 'country-group:ue', 'country-group:world'],
@@ -1,9 +1,17 @@
-from collections import Counter
+import re
 
-from .. import wiki
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from pymongo import UpdateOne, UpdateMany
+
+from .. import wiki, wikidump
+from ..db import ZoneIndex
 from ..model import country_subset
 from ..tools import info, success, warning, error, progress
-from ..tools import aggregate_multipolygons, geom_to_multipolygon, chunker
+from ..geometry import to_multipolygons, union_geometries
+from ..rollup import compute_rollups, ROLLUPS_FIELD
+from ..tools import chunker
 
 from .model import canton, departement, epci, commune, arrondissement, iris, region, collectivite
 from .model import droms, departements_metropole, decoupage_etalab
@@ -11,10 +19,14 @@ from .model import PARIS_DISTRICTS, LYON_DISTRICTS, MARSEILLE_DISTRICTS, WIKIDAT
 from .model import COMMUNES_START
 
 '''
-WARNING:
-    In this file, order matters. First declared is first processed (by level)
+Processors declare the resources they require and provide (ex: `fr:commune:population`).
+A processor only runs once all the processors providing its requirements are done,
+others are processed in declaration order (by level) or concurrently with `--jobs`.
 '''
 
+# Number of EPCIs processed at once by `attach_epci()`
+EPCI_CHUNK_SIZE = 500
+
 
 COUNTRY_SUBSETS_SPARQL = '''
 SELECT DISTINCT ?subset ?subsetLabel ?population ?area ?siren ?geonames ?flag
@@ -42,6 +54,23 @@ WHERE {
 '''  # NOQA: E501
 
 
+def not_flag_of_france(url):
+    return url != WIKIDATA_FLAG_OF_FRANCE
+
+
+COUNTRY_SUBSETS_SELECTION = wikidump.Selection('subset', fields={
+    'geonames': 'P1566',
+    'siren': 'P1616',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, filters={'flag': not_flag_of_france}, wikipedia='frwiki')
+
+
 @country_subset.postprocessor()
 def fetch_french_country_subset_wikidata_metadata(db):
     info('Fetching french country subsets wikidata metadata')
@@ -50,8 +79,7 @@ def fetch_french_country_subset_wikidata_metadata(db):
 
     wdids = ' '.join(f'wd:{id}' for id in ids.keys())
     query = COUNTRY_SUBSETS_SPARQL.replace('{ids}', wdids)
-    results = wiki.data_sparql_query(query)
-    results = wiki.data_reduce_result(results, 'subset')
+    results = wiki.data_query(query, COUNTRY_SUBSETS_SELECTION, list(ids))
 
     for row in results:
         uri = row['subset']
@@ -92,60 +120,74 @@ def fr_postal_codes(db, data):
     borneInferieure : plus petit numéro du tronçon
     borneSuperieure : plus grand numéro du tronçon
     '''
-    processed = 0
+    postal_codes = defaultdict(list)
     for row in progress(data, 'Processing french postal code'):
-        match = db.update_zone(commune.id, row['codeCommune'], ops={
-            '$addToSet': {'keys.postal': row['codePostal']}
-        })
-        if match:
-            processed += 1
+        postal_codes[row['codeCommune']].append(row['codePostal'])
+
+    # Postal codes are grouped by town and written in bulk
+    known = set(db.distinct('code', {'level': commune.id}))
+    processed = 0
+    with db.bulk_writer() as writer:
+        for code, postals in postal_codes.items():
+            if code not in known:
+                continue
+            writer.write(UpdateOne({'level': commune.id, 'code': code}, {
+                '$addToSet': {'keys.postal': {'$each': list(dict.fromkeys(postals))}}
+            }))
+            processed += len(postals)
     success('Processed {0} french postal codes', processed)
 
 
-def _get_parent(db, level, row, field, date):
+def _get_parent(lookups, level, row, field, date):
     code = row
     for part in field.split('.'):
         if not code.get(part):
             return
         code = code[part]
     code = code.lower()
-    parent = db.zone(level.id, code, date)
+    parent = lookups[level.id].get(code)
     if parent:
-        return parent['_id']
+        return parent
     else:
         error('Unable to find zone {0}:{1}@{2}', level.id, code, date)
 
 
-@commune.postprocessor(decoupage_etalab('v0.5.0', 'communes'))
+@commune.postprocessor(decoupage_etalab('v0.5.0', 'communes'),
+                       provides=['fr:commune:parents', 'fr:commune:population'])
 def attach_current_french_communes_parents(db, data):
     processed = 0
     now = '2019-01-01'
-    for row in progress(data, 'Updating current french communes metadata'):
-        parents = [
-            id for id in (
-                _get_parent(db, level, row, field, now)
-                for level, field in (
-                    (region, 'region'),
-                    (departement, 'departement'),
-                    (arrondissement, 'arrondissement'),
-                    (collectivite, 'collectiviteOutremer.code')
-                )
-            ) if id
-        ]
-        ops = {}
-        if parents:
-            ops['$addToSet'] = {'parents': {'$each': parents}}
-        if row.get('population'):
-            ops['$set'] = {'population': row['population']}
-        if not ops:
-            continue
-        zone = db.update_zone(commune.id, row['code'], '2019-01-01', ops)
-        if zone:
-            processed += 1
+    fields = (
+        (region, 'region'),
+        (departement, 'departement'),
+        (arrondissement, 'arrondissement'),
+        (collectivite, 'collectiviteOutremer.code')
+    )
+    # Zones valid at the reference date are looked up in memory
+    lookups = dict((level.id, db.codes(level.id, now)) for level in (commune, *(l for l, _ in fields)))
+    with db.bulk_writer() as writer:
+        for row in progress(data, 'Updating current french communes metadata'):
+            parents = [
+                id for id in (
+                    _get_parent(lookups, level, row, field, now)
+                    for level, field in fields
+                ) if id
+            ]
+            ops = {}
+            if parents:
+                ops['$addToSet'] = {'parents': {'$each': parents}}
+            if row.get('population'):
+                ops['$set'] = {'population': row['population']}
+            if not ops:
+                continue
+            zone_id = lookups[commune.id].get(row['code'])
+            if zone_id:
+                writer.write(UpdateOne({'_id': zone_id}, ops), zone_id)
+                processed += 1
     success('Updated {0} french communes', processed)
 
 
-@commune.postprocessor()
+@commune.postprocessor(requires=['fr:commune:parents'], provides=['fr:commune:districts'])
 def commune_with_districts(db):
     info('Attaching Paris town districts')
     paris = db.find_one({'_id': 'fr:commune:75056@{0}'.format(COMMUNES_START)})
@@ -189,7 +231,7 @@ URI_RDF_PROPERTIES_FR = (
     'o:emblem',
 )
 
-# Number of zones to retrieve by SPARQL query
+# Initial number of zones to retrieve by SPARQL query (adapted at runtime)
 SPARQL_CHUNK_SIZE = 150
 
 
@@ -216,8 +258,21 @@ WHERE {{
 }}
 '''
 
-
-@commune.postprocessor()
+COMMUNES_SELECTION = wikidump.Selection('commune', match=('insee', 'P374'), fields={
+    'geonames': 'P1566',
+    'siren': 'P1616',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, filters={'flag': not_flag_of_france}, wikipedia='frwiki')
+
+
+@commune.postprocessor(requires=['fr:commune:population'],  # Only missing values are fetched
+                       provides=['fr:commune:population', 'fr:commune:area'])
 def fetch_communes_data_from_wikidata(db):
     info('Fetching french communes metadata from wikidata')
     processed = 0
@@ -236,10 +291,11 @@ def fetch_communes_data_from_wikidata(db):
 
     codes = map(lambda r: r['_id'], db.aggregate_with_progress(pipeline))
 
-    for codes in chunker(codes, SPARQL_CHUNK_SIZE):
-        query = COMMUNES_SPARQL_QUERY.replace('{codes}', ' '.join('"{}"'.format(s) for s in codes))
-        results = wiki.data_sparql_query(query)
-        results = wiki.data_reduce_result(results, 'commune')
+    def build(codes):
+        return COMMUNES_SPARQL_QUERY.replace('{codes}', ' '.join('"{}"'.format(s) for s in codes))
+
+    # Queries are executed concurrently and results are processed as they arrive
+    for results in wiki.map_data_chunks(codes, build, COMMUNES_SELECTION, 'communes', SPARQL_CHUNK_SIZE):
         for row in results:
             insee = row['insee'].lower()
             db.update_zone(commune.id, insee, db.TODAY,  ops={
@@ -264,8 +320,8 @@ def fetch_communes_data_from_wikidata(db):
     success('Fetched {0} french communes metadata from wikidata', processed)
 
 
-# Need to be the last processed
-@commune.postprocessor()
+@commune.postprocessor(requires=['fr:commune:parents', 'fr:commune:districts'],
+                       provides=['fr:country-subset:children'])
 def attach_counties_to_subcountries(db):
     info('Attaching French Metropolitan counties')
     ids = [departement['_id'] for departement in departements_metropole(db)]
@@ -320,12 +376,30 @@ WHERE {{
 }}
 '''
 
-
-@region.postprocessor()
+REGIONS_SELECTION = wikidump.Selection('region', match=('insee', 'P2585'), instance_of=['Q36784'], fields={
+    'capital': 'P36',
+    'iso2': 'P300',
+    'fips': 'P901',
+    'geonames': 'P1566',
+    'nuts2': 'P605',
+    'siren': 'P1616',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, aggs=('geonames', 'siren'), required=('capital',), current=('iso2', 'nuts2'), filters={
+    'nuts2': re.compile(r'^FR\d{2}$').match,
+    'flag': not_flag_of_france,
+}, wikipedia='frwiki')
+
+
+@region.postprocessor(provides=['fr:region:population'])
 def fetch_region_data_from_wikidata(db):
     info('Fetching french regions wikidata metadata')
-    results = wiki.data_sparql_query(REGIONS_SPARQL_QUERY)
-    results = wiki.data_reduce_result(results, 'region', 'geonames', 'siren')
+    results = wiki.data_query(REGIONS_SPARQL_QUERY, REGIONS_SELECTION)
     for row in progress(results):
         insee = row['insee'].lower()
         db.update_zone(region.id, insee, db.TODAY,  ops={
@@ -350,104 +424,33 @@ def fetch_region_data_from_wikidata(db):
         })
 
 
-@canton.postprocessor()
+@canton.postprocessor(requires=['fr:country-subset:children'], provides=['fr:canton:parents'])
 def attach_canton_parents(db):
     info('Attaching French Canton to their parents')
-    canton_processed = 0
-    for zone in db.find({'level': canton.id}):
-        candidates_ids = [p for p in zone['parents']
-                          if p.startswith('fr:departement:')]
-        if len(candidates_ids) < 1:
-            warning('No parent candidate found for: {0}', zone['_id'])
-            continue
-        departement_id = candidates_ids[0]
-        departement_zone = db.find_one({'_id': departement_id})
-        if not departement_zone:
-            warning('No county found for: {0}', departement_id)
-            continue
-        ops = {
-            '$addToSet': {'parents': {'$each': departement_zone['parents']}},
-            '$unset': {'_dep': 1}
-        }
-        if db.find_one_and_update({'_id': zone['_id']}, ops):
-            canton_processed += 1
-
+    canton_processed = db.attach_parents(canton.id, departement.id,
+                                         lambda zone, parent: {'$unset': {'_dep': 1}},
+                                         missing='No county found for: {0}')
     success('Attached {0} french cantons to their parents', canton_processed)
 
 
-@iris.postprocessor()
+def _iris_ops(zone, commune_zone):
+    if zone.get('_type') == 'Z':
+        name = commune_zone['name']
+    else:
+        name = ''.join((commune_zone['name'], ' (', zone['name'], ')'))
+    return {
+        '$set': {'name': name},
+        '$unset': {'_town': 1, '_type': 1}
+    }
+
+
+@iris.postprocessor(requires=['fr:country-subset:children'], provides=['fr:iris:parents'])
 def attach_and_clean_iris(db):
     info('Attaching French IRIS to their region')
-    processed = 0
-    for zone in db.find({'level': iris.id}):
-        candidates_ids = [p for p in zone['parents']
-                          if p.startswith('fr:commune:')]
-        if len(candidates_ids) < 1:
-            warning('No parent candidate found for: {0}', zone['_id'])
-            continue
-        commune_id = candidates_ids[0]
-        commune_zone = db.find_one({'_id': commune_id})
-        if not commune_zone:
-            warning('Town {0} not found', commune_id)
-            continue
-        if zone.get('_type') == 'Z':
-            name = commune_zone['name']
-        else:
-            name = ''.join((commune_zone['name'], ' (', zone['name'], ')'))
-        ops = {
-            '$addToSet': {'parents': {'$each': commune_zone['parents']}},
-            '$set': {'name': name},
-            '$unset': {'_town': 1, '_type': 1}
-        }
-        if db.find_one_and_update({'_id': zone['_id']}, ops):
-            processed += 1
+    processed = db.attach_parents(iris.id, commune.id, _iris_ops, missing='Town {0} not found')
     success('Attached {0} french IRIS to their parents', processed)
 
 
-@arrondissement.postprocessor()
-def compute_district_population(db):
-    info('Computing french district population by aggregation')
-    processed = 0
-    pipeline = [
-        {'$match': {'level': commune.id}},
-        {'$unwind': '$parents'},
-        {'$match': {'parents': {'$regex': arrondissement.id}}},
-        {'$group': {'_id': '$parents', 'population': {'$sum': '$population'}}}
-    ]
-    for result in db.aggregate(pipeline):
-        if result.get('population'):
-            if db.find_one_and_update(
-                    {'_id': result['_id']},
-                    {'$set': {'population': result['population']}}):
-                processed += 1
-    success('Computed population for {0} french districts', processed)
-
-
-@departement.postprocessor()
-def compute_departement_area_and_population(db):
-    info('Computing french counties areas and population by aggregation')
-    processed = 0
-    pipeline = [
-        {'$match': {'level': commune.id}},
-        {'$unwind': '$parents'},
-        {'$match': {'parents': {'$regex': 'fr:departement'}}},
-        {'$group': {
-            '_id': '$parents',
-            'area': {'$sum': '$area'},
-            'population': {'$sum': '$population'}
-        }}
-    ]
-    for result in db.aggregate(pipeline):
-        if db.find_one_and_update(
-                {'_id': result['_id']},
-                {'$set': {
-                    'area': result['area'],
-                    'population': result['population']
-                }}):
-            processed += 1
-    success('Computed area and population for {0} french counties', processed)
-
-
 DEPARTEMENT_SPARQL_QUERY = f'''
 SELECT DISTINCT ?dpt ?dptLabel ?insee ?capital ?capitalInsee ?population ?area
                 ?iso2 ?siren ?fips ?nuts3 ?geonames ?flag ?blazon ?logo
@@ -485,12 +488,30 @@ WHERE {{
 }}
 '''
 
-
-@departement.postprocessor()
+DEPARTEMENT_SELECTION = wikidump.Selection('dpt', match=('insee', 'P2586'), instance_of=['Q6465'], fields={
+    'capital': 'P36',
+    'iso2': 'P300',
+    'fips': 'P901',
+    'geonames': 'P1566',
+    'nuts3': 'P605',
+    'siren': 'P1616',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, aggs=('geonames', 'siren'), required=('capital',), current=('iso2', 'nuts3'), filters={
+    'nuts3': re.compile(r'^FR\d{3}$').match,
+    'flag': not_flag_of_france,
+}, wikipedia='frwiki')
+
+
+@departement.postprocessor(provides=['fr:departement:population'])
 def fetch_departement_data_from_wikidata(db):
     info('Fetching french departement wikidata metadata')
-    results = wiki.data_sparql_query(DEPARTEMENT_SPARQL_QUERY)
-    results = wiki.data_reduce_result(results, 'dpt', 'geonames', 'siren')
+    results = wiki.data_query(DEPARTEMENT_SPARQL_QUERY, DEPARTEMENT_SELECTION)
     for row in progress(results):
         insee = row['insee'].lower()
         db.update_zone(departement.id, insee, db.TODAY,  ops={
@@ -511,79 +532,123 @@ def fetch_departement_data_from_wikidata(db):
                 # Siren have no end-time but is sequential (keep last)
                 'keys.siren': next((s for s in sorted(row['siren'], reverse=True)), None),
                 'keys.geonames': row['geonames'],
-            }.items() if v is not None}
+            }.items() if v is not None},
+            # Wikidata values take precedence over rolled up ones
+            '$pull': {ROLLUPS_FIELD: {'$in': ['area', 'population']}},
         })
 
 
-@departement.postprocessor()  # Needs departement population to be computed
-def compute_region_population(db):
-    info('Computing french regions population by aggregation')
-    processed = 0
-    pipeline = [
-        {'$match': {'level': departement.id}},
-        {'$unwind': '$parents'},
-        {'$match': {'parents': {'$regex': 'fr:region'}}},
-        {'$group': {'_id': '$parents', 'population': {'$sum': '$population'}}}
-    ]
-    for result in db.aggregate(pipeline):
-        if result.get('population'):
-            if db.find_one_and_update(
-                    {'_id': result['_id']},
-                    {'$set': {'population': result['population']}}):
-                processed += 1
-    success('Computed population for {0} french regions', processed)
+def epci_geometry(geoms):
+    '''
+    Build an EPCI geometry from its towns ones.
 
+    Towns geometries are simplified one by one when loaded so they share no border
+    to dissolve using a topology: they are unioned.
+    Executed in a worker process: returns a `(geom, error)` tuple.
+    '''
+    try:
+        return union_geometries(to_multipolygons(geoms)).__geo_interface__, None
+    except Exception as e:
+        return None, str(e)
 
-@commune.postprocessor()  # Needs communes population, geometry and area to be processed
-def attach_epci(db):
+
+@commune.postprocessor(requires=['fr:commune:population', 'fr:commune:area'],
+                       provides=['fr:epci:members', 'fr:epci:area'], parallel=True)
+def attach_epci(db, workers=None):
     '''
     Attach EPCI towns to their EPCI from
     and build EPCI geometry when available
+
+    Towns are resolved from an in-memory index and EPCIs are processed by chunks:
+    geometries of each distinct towns set are built once (in a pool of `workers`
+    processes if given) and all updates are sent as bulk writes.
     '''
     info('Processing EPCI town list')
     count = Counter()
-    for zone in progress(db.find({'level': epci.id}), 'Attaching EPCIs members'):
-        towns = [
-            db.zone(commune.id, code.lower().zfill(5), zone['validity']['start'])
-            for code in zone['_towns']
-        ]
-        ids = [t['_id'] for t in towns]
-
-        # Attach EPCI as towns parent
-        result = db.update_many(
-            {'_id': {'$in': ids}},
-            {'$addToSet': {'parents': zone['_id']}})
-        count['processed'] += result.modified_count
-
-        # Try to construct geometries and compute areas
-        geoms, areas = zip(*[
-            (t.get('geom'), t.get('area'))
-            for t in db.find({'_id': {'$in': ids}})
-        ])
-        if all(geoms):
-            try:
-                polygons = [geom_to_multipolygon(geom) for geom in geoms]
-                aggregated = aggregate_multipolygons(polygons)
-                zone['geom'] = aggregated.__geo_interface__
-                db.find_one_and_replace({'_id': zone['_id']}, zone)
-                count['geometries'] += 1
-            except Exception as e:
-                warning('Unable to process geometry for "{0}": {1}',
-                        zone['_id'], str(e))
-        if all(areas):
-            try:
-                area = sum(areas)
-                db.update_one({'_id': zone['_id']}, {'$set': {'area': area}})
-                count['areas'] += 1
-            except Exception as e:
-                warning('Unable to process area for "{0}": {1}',
-                        zone['_id'], str(e))
-
-    success('Attached {0} french towns to their EPCI', count['processed'])
+    towns = ZoneIndex(db, commune.id)
+    query = {'level': epci.id}
+    projection = {'_towns': True, 'validity': True}
+    epcis = progress(db.find(query, projection), 'Attaching EPCIs members',
+                     length=db.count_documents(query))
+    geometries = {}  # Built geometries by towns set
+    pool = ProcessPoolExecutor(workers) if workers else None
+    try:
+        with db.bulk_writer() as writer:
+            for chunk in chunker(epcis, EPCI_CHUNK_SIZE):
+                members = {}
+                for zone in chunk:
+                    ids = []
+                    for code in zone['_towns']:
+                        town_id = towns.zone_id(code.lower().zfill(5), zone['validity']['start'])
+                        if town_id:
+                            ids.append(town_id)
+                        else:
+                            warning('Town {0} not found for "{1}"', code, zone['_id'])
+                    members[zone['_id']] = ids
+                    if ids:
+                        # Attach EPCI as towns parent
+                        writer.write(UpdateMany({'_id': {'$in': ids}}, {'$addToSet': {'parents': zone['_id']}}))
+                        count['members'] += len(ids)
+                        count['epcis'] += 1
+
+                # Try to construct geometries and compute areas
+                ids = set(town_id for town_ids in members.values() for town_id in town_ids)
+                found = dict(
+                    (t['_id'], t)
+                    for t in db.find({'_id': {'$in': list(ids)}}, {'geom': True, 'area': True})
+                )
+                tasks = {}
+                for town_ids in members.values():
+                    key = frozenset(town_ids)
+                    if key in geometries or key in tasks or not town_ids:
+                        continue
+                    geoms = [found.get(town_id, {}).get('geom') for town_id in town_ids]
+                    if all(geoms):
+                        tasks[key] = geoms
+                if pool:
+                    futures = dict((key, pool.submit(epci_geometry, geoms)) for key, geoms in tasks.items())
+                    geometries.update((key, future.result()) for key, future in futures.items())
+                else:
+                    geometries.update((key, epci_geometry(geoms)) for key, geoms in tasks.items())
+
+                for zone_id, town_ids in members.items():
+                    if not town_ids:
+                        continue
+                    geom, err = geometries.get(frozenset(town_ids), (None, None))
+                    if geom:
+                        writer.write(UpdateOne({'_id': zone_id}, {'$set': {'geom': geom}}))
+                        count['geometries'] += 1
+                    elif err:
+                        warning('Unable to process geometry for "{0}": {1}', zone_id, err)
+                    areas = [found.get(town_id, {}).get('area') for town_id in town_ids]
+                    if all(areas):
+                        writer.write(UpdateOne({'_id': zone_id}, {'$set': {'area': sum(areas)}}))
+                        count['areas'] += 1
+    finally:
+        if pool:
+            pool.shutdown()
+
+    success('Attached {0} french towns to {1} EPCIs', count['members'], count['epcis'])
     success('Constructed {0} french EPCI geometry', count['geometries'])
     success('Computed {0} french EPCI areas', count['areas'])
 
 
+# Populations and areas are rolled up from communes once their own ones are known
+arrondissement.rollup(commune, 'population')
+# Wikidata values take precedence for counties
+departement.rollup(commune, 'area', 'population', fallback=True)
+region.rollup(departement, 'population')
+
+
+@commune.postprocessor(requires=['fr:commune:parents', 'fr:commune:population', 'fr:commune:area',
+                                 'fr:departement:population', 'fr:region:population'],
+                       provides=['fr:arrondissement:population', 'fr:departement:area'])
+def compute_french_rollups(db):
+    info('Computing french districts, counties and regions populations and areas')
+    processed = compute_rollups(db, [arrondissement, departement, region])
+    success('Updated {0} french zones', processed)
+
+
 EPCI_SPARQL_QUERY = f'''
 SELECT DISTINCT ?epci ?epciLabel ?siren ?population ?area
                 ?flag ?blazon ?logo ?site ?wikipedia ?osm
@@ -606,8 +671,18 @@ WHERE {{
 }}
 '''
 
+EPCI_SELECTION = wikidump.Selection('epci', match=('siren', 'P1616'), group='siren', fields={
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, filters={'flag': not_flag_of_france}, wikipedia='frwiki')
+
 
-@epci.postprocessor()
+@epci.postprocessor(requires=['fr:epci:area'])  # Overrides computed EPCI areas
 def fetch_epci_data_from_wikidata(db):
     info('Fetching french EPCIs wikidata metadata')
 
@@ -620,10 +695,11 @@ def fetch_epci_data_from_wikidata(db):
 
     sirens = map(lambda r: r['_id'], db.aggregate_with_progress(pipeline))
 
-    for sirens in chunker(sirens, SPARQL_CHUNK_SIZE):
-        query = EPCI_SPARQL_QUERY.replace('{sirens}', ' '.join('"{}"'.format(s) for s in sirens))
-        results = wiki.data_sparql_query(query)
-        results = wiki.data_reduce_result(results, 'siren')
+    def build(sirens):
+        return EPCI_SPARQL_QUERY.replace('{sirens}', ' '.join('"{}"'.format(s) for s in sirens))
+
+    # Queries are executed concurrently and results are processed as they arrive
+    for results in wiki.map_data_chunks(sirens, build, EPCI_SELECTION, 'epci', SPARQL_CHUNK_SIZE):
         for row in results:
             siren = row['siren']
             r = db.update_zones(epci.id, siren, db.TODAY,  ops={
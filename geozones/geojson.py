@@ -5,6 +5,9 @@ from colorhash import ColorHash
 
 from .tools import unicodify
 
+# Indentation of pretty printed files
+PRETTY_INDENT = 4
+
 
 def colorize(zone):
     return ColorHash(zone['_id']).hex
@@ -84,8 +87,36 @@ def dumps(zones, pretty=False):
 
 
 def dump(zones, out, pretty=False, keys=None):
-    data = dump_zones(zones, keys=keys)
-    if pretty:
-        return json.dump(data, out, indent=4)
-    else:
-        return json.dump(data, out)
+    '''
+    Write a zones queryset as a GeoJSON FeatureCollection.
+
+    Features are serialized and written one by one so memory usage
+    does not depend on the number of zones.
+    The output is identical to a `json.dump()` of `dump_zones()`.
+    '''
+    crs = json.dumps(fiona.crs.from_epsg(4326), indent=PRETTY_INDENT if pretty else None)
+    if not pretty:
+        out.write('{"type": "FeatureCollection", "features": [')
+        for i, zone in enumerate(zones):
+            if i:
+                out.write(', ')
+            out.write(json.dumps(zone_to_feature(zone, keys)))
+        out.write('], "crs": {0}}}'.format(crs))
+        return
+    padding = ' ' * PRETTY_INDENT
+    out.write('{{\n{0}"type": "FeatureCollection",\n{0}"features": ['.format(padding))
+    empty = True
+    for zone in zones:
+        feature = json.dumps(zone_to_feature(zone, keys), indent=PRETTY_INDENT)
+        out.write('\n' if empty else ',\n')
+        out.write(_indent(feature, padding * 2))
+        empty = False
+    if not empty:
+        out.write('\n' + padding)
+    out.write('],\n{0}"crs": {1}\n}}'.format(padding, _indent(crs, padding, first=False)))
+
+
+def _indent(text, padding, first=True):
+    '''Indent all lines of a text (but the first one unless `first` is set)'''
+    lines = text.split('\n')
+    return '\n'.join(padding + line if first or i else line for i, line in enumerate(lines))
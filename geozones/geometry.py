@@ -0,0 +1,244 @@
+'''
+Geometry processing helpers
+
+Those functions only deal with raw GeoJSON-like or WKB geometries
+so they can be executed into worker processes.
+
+Geometries are processed by chunks as Shapely 2 geometries arrays
+with vectorized functions.
+'''
+import hashlib
+import json
+import traceback
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy
+import shapely
+
+from shapely import wkb
+from shapely.geometry import shape, MultiPolygon
+from shapely.validation import explain_validity
+
+from .tools import chunker, warning
+
+POLYGON = shapely.GeometryType.POLYGON
+MULTIPOLYGON = shapely.GeometryType.MULTIPOLYGON
+
+# Number of geometries sent to a worker process at once
+GEOMETRY_CHUNK_SIZE = 200
+# Number of geometries processed at once by vectorized functions
+VECTORIZED_CHUNK_SIZE = 2000
+# Number of neighbour geometries unioned together by the first reduction pass
+UNION_CHUNK_SIZE = 32
+# Resolution of the Z-order curve used to sort geometries spatially
+ZORDER_BITS = 16
+
+
+def prepare_geometry(geometry, simplify=None):
+    '''
+    Prepare a raw geometry for storage.
+
+    The geometry is simplified if requested and cast into a MultiPolygon.
+    Returns a `(geom_type, geom, invalidity)` tuple where:
+
+        - `geom_type` is the (simplified) geometry type
+        - `geom` is the GeoJSON MultiPolygon or `None` if the type is not supported
+        - `invalidity` is the explanation of the geometry invalidity if any
+    '''
+    geom = to_shape(geometry)
+    if simplify:
+        geom = geom.simplify(simplify)
+    geom_type = geom.geom_type
+    if geom_type == 'Polygon':
+        geom = MultiPolygon([geom])
+    elif geom_type != 'MultiPolygon':
+        return geom_type, None, None
+    invalidity = None if geom.is_valid else explain_validity(geom)
+    return geom_type, geom.__geo_interface__, invalidity
+
+
+def to_shape(geometry):
+    '''Build a geometry from a raw GeoJSON-like or WKB geometry'''
+    return wkb.loads(geometry) if isinstance(geometry, bytes) else shape(geometry)
+
+
+def geojson_text(geometry):
+    '''Serialize a raw GeoJSON-like geometry, either a mapping or a Fiona geometry'''
+    return json.dumps(getattr(geometry, '__geo_interface__', geometry))
+
+
+def geometry_array(geometries):
+    '''
+    Build a geometries array from raw GeoJSON-like or WKB geometries.
+    '''
+    if geometries and all(isinstance(geometry, bytes) for geometry in geometries):
+        return shapely.from_wkb(geometries)
+    return shapely.from_geojson([geojson_text(geometry) for geometry in geometries])
+
+
+def geometry_flags(geoms):
+    '''Get both `is_valid` and `is_empty` flags for a sequence of geometries'''
+    return shapely.is_valid(geoms), shapely.is_empty(geoms)
+
+
+def geometry_hashes(geoms):
+    '''Compute the SHA-1 hexdigest of each geometry WKB'''
+    wkbs = shapely.to_wkb(numpy.asarray(geoms, dtype=object)) if len(geoms) else []
+    return [hashlib.sha1(data).hexdigest() for data in wkbs]
+
+
+def to_multipolygons(geometries):
+    '''
+    Cast raw geometries into MultiPolygons.
+
+    Raises a `ValueError` on the first invalid, empty or unsupported geometry.
+    '''
+    geoms = geometry_array(geometries)
+    valid, empty = geometry_flags(geoms)
+    if not valid.all():
+        raise ValueError('Invalid polygon')
+    elif empty.any():
+        raise ValueError('Empty polygon')
+    type_ids = shapely.get_type_id(geoms)
+    unsupported = (type_ids != POLYGON) & (type_ids != MULTIPOLYGON)
+    if unsupported.any():
+        geom_type = geoms[unsupported][0].geom_type
+        raise ValueError('Unsupported geometry type "{0}"'.format(geom_type))
+    polygons = type_ids == POLYGON
+    if polygons.any():
+        geoms[polygons] = shapely.multipolygons(geoms[polygons][:, numpy.newaxis])
+    return geoms
+
+
+def prepare_geometries(geometries, simplify=None):
+    '''
+    Prepare a chunk of raw geometries.
+
+    Failures are returned as formatted tracebacks instead of being raised
+    so a single faulty geometry does not fail the whole chunk.
+    '''
+    try:
+        return _prepare_vectorized(geometries, simplify)
+    except (shapely.errors.ShapelyError, TypeError, ValueError) as e:
+        # Fallback on one by one processing to isolate failures
+        warning('Unable to process {0} geometries at once, processing them one by one: {1}',
+                len(geometries), e)
+    results = []
+    for geometry in geometries:
+        try:
+            results.append(prepare_geometry(geometry, simplify))
+        except Exception:
+            results.append(traceback.format_exc())
+    return results
+
+
+def _prepare_vectorized(geometries, simplify=None):
+    '''Vectorized `prepare_geometry()` on a chunk of raw geometries'''
+    geoms = geometry_array(geometries)
+    if simplify:
+        geoms = shapely.simplify(geoms, simplify)
+    type_ids = shapely.get_type_id(geoms)
+    polygons = type_ids == POLYGON
+    supported = polygons | (type_ids == MULTIPOLYGON)
+    if polygons.any():
+        geoms[polygons] = shapely.multipolygons(geoms[polygons][:, numpy.newaxis])
+    valid = shapely.is_valid(geoms)
+    invalidities = numpy.full(len(geoms), None, dtype=object)
+    invalid = supported & ~valid
+    if invalid.any():
+        invalidities[invalid] = shapely.is_valid_reason(geoms[invalid])
+    return [
+        ('Polygon' if is_polygon else geom.geom_type, geom.__geo_interface__, invalidity)
+        if is_supported else (geom.geom_type, None, None)
+        for geom, is_polygon, is_supported, invalidity
+        in zip(geoms, polygons, supported, invalidities)
+    ]
+
+
+def iter_prepared(features, simplify=None, workers=None, chunk_size=GEOMETRY_CHUNK_SIZE):
+    '''
+    Iterate over `(feature, prepared)` tuples, keeping the features order.
+
+    Geometries are prepared by vectorized chunks, in a process pool with `workers`.
+    `prepared` is either a `prepare_geometry()` result or a formatted traceback string.
+    '''
+    if not workers:
+        for chunk in chunker(features, VECTORIZED_CHUNK_SIZE):
+            geometries = [feature['geometry'] for feature in chunk]
+            yield from zip(chunk, prepare_geometries(geometries, simplify))
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in chunker(features, chunk_size):
+            geometries = [feature['geometry'] for feature in chunk]
+            pending.append((chunk, pool.submit(prepare_geometries, geometries, simplify)))
+            # Keep enough chunks in flight to feed every worker
+            # without reading the whole dataset in memory
+            if len(pending) > 2 * workers:
+                chunk, future = pending.popleft()
+                yield from zip(chunk, future.result())
+        while pending:
+            chunk, future = pending.popleft()
+            yield from zip(chunk, future.result())
+
+
+def zorder(x, y, bits=ZORDER_BITS):
+    '''Interleave the bits of two integer coordinates into a Z-order curve index'''
+    index = 0
+    for bit in range(bits):
+        index |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return index
+
+
+def spatial_order(geoms):
+    '''
+    Sort geometries along a Z-order curve of their bounding boxes centers
+    so that consecutive geometries are close to each other.
+    '''
+    bounds = shapely.bounds(numpy.asarray(geoms, dtype=object)).tolist()
+    centers = [((minx + maxx) / 2, (miny + maxy) / 2) for minx, miny, maxx, maxy in bounds]
+    xs, ys = zip(*centers)
+    min_x, min_y = min(xs), min(ys)
+    scale = ((1 << ZORDER_BITS) - 1) / (max(max(xs) - min_x, max(ys) - min_y) or 1)
+    keys = [zorder(int((x - min_x) * scale), int((y - min_y) * scale)) for x, y in centers]
+    return [geoms[i] for _, i in sorted(zip(keys, range(len(geoms))))]
+
+
+def union(geoms, grid_size=None):
+    '''
+    Union geometries in a single pass.
+
+    `grid_size` snaps the result on a precision grid.
+    '''
+    return shapely.union_all(geoms, grid_size=grid_size)
+
+
+def union_geometries(geoms, workers=None, grid_size=None, chunk_size=UNION_CHUNK_SIZE):
+    '''
+    Union geometries into a single MultiPolygon.
+
+    With `workers`, geometries are spatially ordered then unioned
+    by chunks of neighbours and the partial unions are merged pairwise
+    until a single one remains, each reduction pass being spread across
+    a pool of `workers` processes.
+    Otherwise, they are unioned in a single pass (GEOS already cascades it).
+    '''
+    geoms = list(geoms)
+    reduce = partial(union, grid_size=grid_size)
+    if not workers or len(geoms) <= chunk_size:
+        aggregated = reduce(geoms)
+    else:
+        geoms = spatial_order(geoms)
+        with ProcessPoolExecutor(workers) as pool:
+            chunks = [geoms[i:i + chunk_size] for i in range(0, len(geoms), chunk_size)]
+            while len(chunks) > 1:
+                geoms = list(pool.map(reduce, chunks))
+                chunks = [geoms[i:i + 2] for i in range(0, len(geoms), 2)]
+            aggregated = reduce(chunks[0])
+    if aggregated.geom_type == 'Polygon':
+        aggregated = MultiPolygon([aggregated])
+    return aggregated
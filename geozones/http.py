@@ -16,12 +16,22 @@ def post(url, data=None, json=None, retry=3, **kwargs):
     return session.post(url, data=data, json=json, **kwargs)
 
 
-def _with_retries(retry=3):
+def session(retry=3, pool_size=10):
+    '''
+    Get a session with retries keeping up to `pool_size` connections alive by host.
+
+    The session is meant to be reused across requests (and threads).
+    '''
+    return _with_retries(retry, pool_size)
+
+
+def _with_retries(retry=3, pool_size=10):
     session = requests.Session()
     retries = Retry(total=retry, backoff_factor=0.2,
                     status_forcelist=[500, 502, 503, 504],
                     method_whitelist=frozenset(['GET', 'POST'])
                     )
-    session.mount('http://', HTTPAdapter(max_retries=retries))
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
     return session
@@ -1,4 +1,6 @@
-from . import wiki
+import re
+
+from . import wiki, wikidump
 from .model import country, country_group
 from .tools import info, warning, success, progress
 
@@ -91,7 +93,7 @@ def extract_country(db, polygon):
 
 
 @country.extractor('https://github.com/apihackers/geo-countries-simplified/releases/download/'
-                   '2019-05-06/countries.geojson')
+                   '2019-05-06/countries.geojson', index=True)
 def extract_countries(db, polygon):
     '''
     Use cleaner shapes from Datahub geo countries: https://datahub.io/core/geo-countries
@@ -155,6 +157,15 @@ WHERE
 }}
 '''
 
+COUNTRY_GROUPS_SELECTION = wikidump.Selection('grp', fields={
+    'area': 'P2046',
+    'population': 'P1082',
+    'geonames': 'P1566',
+    'flag': 'P41',
+    'osm': 'P402',
+    'site': 'P856',
+}, required=('area', 'population'), wikipedia='enwiki')
+
 
 @country_group.postprocessor()
 def fetch_country_groups_data_from_wikidata(db):
@@ -164,8 +175,7 @@ def fetch_country_groups_data_from_wikidata(db):
 
     wdids = ' '.join(f'wd:{id}' for id in ids.keys())
     query = COUNTRY_GROUPS_SPARQL_QUERY.format(ids=wdids)
-    results = wiki.data_sparql_query(query)
-    results = wiki.data_reduce_result(results, 'grp')
+    results = wiki.data_query(query, COUNTRY_GROUPS_SELECTION, list(ids))
 
     for row in results:
         uri = row['grp']
@@ -220,12 +230,26 @@ WHERE
 }
 '''
 
+COUNTRIES_SELECTION = wikidump.Selection('country', match=('iso2', 'P297'), instance_of=['Q3624078'], fields={
+    'capital': 'P36',
+    'area': 'P2046',
+    'population': 'P1082',
+    'iso3': 'P298',
+    'nuts': 'P605',
+    'fips': 'P901',
+    'geonames': 'P1566',
+    'flag': 'P41',
+    'osm': 'P402',
+    'site': 'P856',
+}, required=('capital', 'area', 'population'), current=('iso2', 'iso3', 'nuts'), filters={
+    'nuts': re.compile(r'^\w{2}$').match,
+}, wikipedia='enwiki')
+
 
 @country.postprocessor()
 def fetch_country_data_from_wikidata(db):
     info('Fetching countries wikidata metadata')
-    results = wiki.data_sparql_query(COUNTRIES_SPARQL_QUERY)
-    results = wiki.data_reduce_result(results, 'country')
+    results = wiki.data_query(COUNTRIES_SPARQL_QUERY, COUNTRIES_SELECTION)
     for row in progress(results):
         iso2 = row['iso2'].lower()
         db.update_zone(country.id, iso2, ops={
@@ -3,12 +3,22 @@ import json
 # import os
 
 from contextlib import contextmanager
+from datetime import date
 from zipfile import ZipFile
 
 import fiona
 
+try:
+    import pyogrio
+except ImportError:  # Optional Arrow support
+    pyogrio = None
+
 
 _loaders = {}
+_arrow_paths = {}
+
+# Number of features read at once by Arrow loaders
+ARROW_BATCH_SIZE = 10000
 
 
 def loader(ext):
@@ -32,9 +42,25 @@ def load(fname, **kwargs):
         yield fname
 
 
-@loader('.zip')
-def load_shp_zip(fname, encoding='latin-1', **kwargs):
-    # Identify the shapefile to avoid multiple file error on GDAL 2
+def arrow_path(ext, **defaults):
+    '''
+    Register a GDAL path resolver for Arrow loading of a given extension
+    with its default loading parameters.
+    '''
+    def wrapper(func):
+        _arrow_paths[ext] = (func, defaults)
+        return func
+    return wrapper
+
+
+def _find(registry, fname):
+    '''Find the registered value for the longuest matching extension'''
+    items = sorted(registry.items(), key=lambda i: len(i[0]), reverse=True)
+    return next((v for e, v in items if fname.endswith(e)), None)
+
+
+def _find_shapefile(fname):
+    '''Identify the shapefile to avoid multiple file error on GDAL 2'''
     with ZipFile(fname) as z:
         candidates = [n for n in z.namelist() if n.endswith('.shp')]
         if len(candidates) > 1:
@@ -49,8 +75,12 @@ def load_shp_zip(fname, encoding='latin-1', **kwargs):
         if len(candidates) != 1:
             msg = 'Unable to find a unique shapefile into {0} {1}'
             raise ValueError(msg.format(fname, candidates))
-        shp = candidates[0]
+        return candidates[0]
+
 
+@loader('.zip')
+def load_shp_zip(fname, encoding='latin-1', **kwargs):
+    shp = _find_shapefile(fname)
     with fiona.open('/{0}'.format(shp),
                     vfs='zip://{0}'.format(fname),
                     encoding=encoding) as collection:
@@ -80,3 +110,71 @@ def load_csv(fname, encoding='utf8', delimiter=',', quotechar='"', **kwargs):
     with open(fname) as infile:
         reader = csv.DictReader(infile, delimiter=delimiter, quotechar=quotechar)
         yield reader
+
+
+def supports_arrow(fname):
+    '''Wether a file can be loaded with pyogrio'''
+    return pyogrio is not None and _find(_arrow_paths, fname) is not None
+
+
+class ArrowCollection(object):
+    '''
+    A features collection read with pyogrio.
+
+    Iterating over it yields fiona-like features
+    with WKB geometries and dates as ISO strings.
+    Only the given `columns` are read (all by default).
+    '''
+    def __init__(self, path, layer=None, encoding=None, batch_size=ARROW_BATCH_SIZE, columns=None):
+        self.path = path
+        self.layer = layer
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.columns = columns
+        info = pyogrio.read_info(path, layer=layer, encoding=encoding)
+        self.driver = info['driver']
+        self.crs = info['crs']
+        self.length = info['features']
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        with pyogrio.open_arrow(self.path, layer=self.layer, encoding=self.encoding, columns=self.columns,
+                                batch_size=self.batch_size, use_pyarrow=True) as (meta, reader):
+            geometry_name = meta.get('geometry_name') or 'wkb_geometry'
+            for batch in reader:
+                columns = [name for name in batch.schema.names if name != geometry_name]
+                properties, geometries = batch.select(columns), batch.column(geometry_name)
+                for props, geometry in zip(properties.to_pylist(), geometries.to_pylist()):
+                    yield {
+                        'type': 'Feature',
+                        'properties': {
+                            k: v.isoformat() if isinstance(v, date) else v
+                            for k, v in props.items()
+                        },
+                        'geometry': geometry,
+                    }
+
+
+@contextmanager
+def load_arrow(fname, layer=None, encoding=None, columns=None, **kwargs):
+    '''Load a supported file as an `ArrowCollection`, only reading the given `columns` if any'''
+    resolver, defaults = _find(_arrow_paths, fname)
+    yield ArrowCollection(resolver(fname), layer=layer, encoding=encoding or defaults.get('encoding'),
+                          columns=columns)
+
+
+@arrow_path('.zip', encoding='latin-1')
+def shp_zip_path(fname):
+    return '/vsizip/{0}/{1}'.format(fname, _find_shapefile(fname))
+
+
+@arrow_path('.geojson')
+def geojson_path(fname):
+    return fname
+
+
+@arrow_path('.geojson.gz')
+def gzipped_geojson_path(fname):
+    return '/vsigzip/{0}'.format(fname)
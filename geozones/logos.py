@@ -1,64 +1,379 @@
+import hashlib
+import io
+import json
 import os
+import re
 import tarfile
+import threading
+import time
+import traceback
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
 
 from . import http
-from .tools import info, success, unicodify, progress
+from .tools import info, success, warning, error, unicodify, progress, file_sha256
+from .wiki import TokenBucket
+
+try:
+    from PIL import Image
+except ImportError:  # Optional derivatives support
+    Image = None
+
+try:
+    import cairosvg
+except (ImportError, OSError):  # Optional SVG rasterization support (OSError without the Cairo library)
+    cairosvg = None
 
 WIKIMEDIA_COMMONS_URL = 'https://commons.wikimedia.org/wiki/Special:FilePath/'
 LOGOS_FOLDER_PATH = 'logos'
 LOGOS_FILENAME = 'geologos.tar.xz'
+# ETag and Last-Modified headers of fetched files, stored into the logos folder
+LOGOS_INDEX = 'index.json'
+LOGOS_LOG = 'logos.json'
 
 # Define a user agent to follow https://www.mediawiki.org/wiki/API:Etiquette
 USER_AGENT = 'geozones/1.0 (https://github.com/etalab/geozones)'
 HEADERS = {'user-agent': USER_AGENT}
 
+# Number of concurrent downloads
+LOGOS_CONCURRENCY = 4
+# Maximum number of requests by second and by host
+LOGOS_RATE = 5
+LOGOS_RETRIES = 3
+LOGOS_TIMEOUT = 60
+MAX_REDIRECTS = 5
 
-def fetch_logos(zones, dist_dir, batch_size=50):
-    """
-    Fetch logos (logos or flags or blazons) from `zones`.
+# Derivatives are stored by content hash into the derivatives folder
+DERIVATIVES_FOLDER_PATH = 'logos-derivatives'
+DERIVATIVES_MANIFEST = 'manifest.json'
+# Raster thumbnails sizes (in pixels, thumbnails are squares)
+THUMBNAIL_SIZES = (64, 128, 256)
 
-    Not optimized to avoid being blacklisted by wikimedia.
-    That command takes about 3h30 as of February 2016.
+RE_SVG_COMMENT = re.compile(r'<!--.*?-->', re.S)
+RE_SVG_METADATA = re.compile(r'<metadata\b.*?</metadata>|<metadata\b[^>]*/>', re.S)
+RE_SVG_EDITOR = re.compile(
+    r'<(sodipodi|inkscape):[\w-]+\b[^>]*/>|<(sodipodi|inkscape):([\w-]+)\b.*?</\2:\3>', re.S)
+RE_SVG_EDITOR_ATTRS = re.compile(r'\s(?:sodipodi|inkscape):[\w-]+="[^"]*"')
+# Whitespaces between tags, texts elements (whose whitespaces are significant) being matched as a group
+RE_SVG_WHITESPACES = re.compile(r'(<text\b.*?</text(?=>))|>\s+(?=<)', re.S)
 
-    Existing files are not fetched but previous 404 are retried.
-    """
-    info('Fetching logos from Wikimedia')
-    path = os.path.join(dist_dir, LOGOS_FOLDER_PATH)
-    logfile_path = os.path.join(dist_dir, 'logos.log')
-    logfile = open(logfile_path, 'w')
-    if not os.path.exists(path):
-        os.makedirs(path)
-    downloaded = 0
+# Fetch results
+DOWNLOADED = 'downloaded'
+NOT_MODIFIED = 'not-modified'
+FAILED = 'failed'
+
+
+class LogoFetcher(object):
+    '''
+    Fetch files from Wikimedia Commons.
+
+    Files are downloaded by up to `concurrency` threads through a shared
+    keep-alive connections pool, at most `rate` requests by second on each host
+    (redirections are followed manually to be rate limited too).
+    Files having known validators (ETag or Last-Modified) are fetched
+    with conditional requests and only downloaded again if modified.
+    '''
+    def __init__(self, path, concurrency=LOGOS_CONCURRENCY, rate=LOGOS_RATE, retries=LOGOS_RETRIES):
+        self.path = path
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.session = http.session(pool_size=concurrency)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(path, LOGOS_INDEX)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def bucket(self, url):
+        '''Get the rate limiter of an URL host'''
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate)
+            return self.buckets[host]
+
+    def request(self, url, headers):
+        '''Perform a rate limited GET request following redirections'''
+        for _ in range(MAX_REDIRECTS + 1):
+            for attempt in range(self.retries + 1):
+                self.bucket(url).acquire()
+                response = self.session.get(url, headers=headers, stream=True, allow_redirects=False,
+                                            timeout=LOGOS_TIMEOUT)
+                if response.status_code != 429 or attempt == self.retries:
+                    break
+                response.close()
+                retry_after = response.headers.get('Retry-After', '')
+                time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt)
+            if not response.is_redirect:
+                return response
+            url = urljoin(url, response.headers['location'])
+            response.close()
+        raise http.TooManyRedirects('Too many redirections for {0}'.format(url))
+
+    def fetch(self, filename):
+        '''Fetch a single file and returns its result as a dictionnary'''
+        url = WIKIMEDIA_COMMONS_URL + unicodify(filename)
+        filepath = os.path.join(self.path, filename)
+        result = {'filename': filename, 'url': url}
+        headers = dict(HEADERS)
+        validators = self.index.get(filename, {})
+        # Files fetched before validators were stored are fetched again to get them
+        if os.path.exists(filepath):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        try:
+            response = self.request(url, headers)
+            try:
+                result['code'] = response.status_code
+                if response.status_code == 304:
+                    result['status'] = NOT_MODIFIED
+                elif response.status_code != 200:
+                    result['status'] = FAILED
+                else:
+                    tmp = filepath + '.part'
+                    with open(tmp, 'wb') as out:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            out.write(chunk)
+                    os.replace(tmp, filepath)
+                    result['status'] = DOWNLOADED
+                    result['size'] = os.path.getsize(filepath)
+                    result['validators'] = {
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                    }
+            finally:
+                response.close()
+        except (http.RequestException, OSError) as e:  # Network or file writing errors
+            result['status'] = FAILED
+            result['error'] = str(e)
+        return result
+
+    def fetch_all(self, filenames):
+        '''Fetch files concurrently, yielding their results as they complete'''
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            futures = [pool.submit(self.fetch, filename) for filename in filenames]
+            for future in as_completed(futures):
+                result = future.result()
+                validators = result.pop('validators', None)
+                if validators:
+                    self.index[result['filename']] = validators
+                yield result
+
+    def save_index(self):
+        with open(self.index_path, 'w') as out:
+            json.dump(self.index, out, indent=2, sort_keys=True)
+
+
+def zones_logos(zones, batch_size=50):
+    '''Get the logo filename of zones (a flag, a blazon or a logo) by zone identifier'''
     query = {'$or': [
         {'flag': {'$exists':  True}},
         {'blazon': {'$exists':  True}},
         {'logo': {'$exists':  True}}
     ]}
-    count = zones.count(query)
-    cursor = zones.find(query, no_cursor_timeout=True).batch_size(batch_size)
-    for zone in progress(cursor, length=count):
+    projection = {'flag': True, 'blazon': True, 'logo': True}
+    logos = {}
+    cursor = zones.find(query, projection).batch_size(batch_size)
+    for zone in progress(cursor, 'Listing logos', length=zones.count_documents(query)):
         filename = zone.get('flag', zone.get('blazon', zone.get('logo')))
-        if not filename:
-            continue
-        filepath = os.path.join(path, filename)
+        if filename:
+            logos[zone['_id']] = filename
+    return logos
 
-        if os.path.exists(filepath):
-            logfile.write('{0} : skipped\n'.format(filename))
-            logfile.flush()
-            continue
 
-        url = WIKIMEDIA_COMMONS_URL + unicodify(filename)
-        r = http.get(url, stream=True, headers=HEADERS)
-        if r.status_code != 200:
-            logfile.write('{0} : {1}\n'.format(url, r.status_code))
-            logfile.flush()
+def fetch_logos(zones, dist_dir, batch_size=50, concurrency=LOGOS_CONCURRENCY, rate=LOGOS_RATE):
+    """
+    Fetch logos (logos or flags or blazons) from `zones`.
+
+    Each distinct file is fetched once whatever the number of zones using it.
+    Existing files are only downloaded again if they changed
+    (or never when they have been fetched without validators)
+    and previous errors are retried.
+    Results are logged as JSON into `logos.json`.
+    """
+    info('Fetching logos from Wikimedia')
+    path = os.path.join(dist_dir, LOGOS_FOLDER_PATH)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    filenames = Counter(zones_logos(zones, batch_size).values())
+    info('{0} distinct files used by {1} zones', len(filenames), sum(filenames.values()))
+
+    fetcher = LogoFetcher(path, concurrency, rate)
+    results = []
+    count = Counter()
+    try:
+        for result in progress(fetcher.fetch_all(filenames), 'Fetching logos', length=len(filenames)):
+            result['zones'] = filenames[result['filename']]
+            if result['status'] == FAILED:
+                warning('Unable to fetch {0}: {1}', result['url'], result.get('error', result.get('code')))
+            count[result['status']] += 1
+            results.append(result)
+    finally:
+        # Keep the validators of the already downloaded files whatever happens
+        fetcher.save_index()
+
+    with open(os.path.join(dist_dir, LOGOS_LOG), 'w') as out:
+        json.dump({
+            'date': datetime.now().isoformat(),
+            'summary': count,
+            'results': sorted(results, key=lambda r: r['filename']),
+        }, out, indent=2)
+    success('{0} logos fetched, {1} not modified and {2} failed for {3} candidates',
+            count[DOWNLOADED], count[NOT_MODIFIED], count[FAILED], len(filenames))
+
+
+def minify_svg(data):
+    '''Strip comments, metadata, editors data and whitespaces between tags (outside texts) from a SVG'''
+    svg = data.decode('utf-8')
+    for pattern in (RE_SVG_COMMENT, RE_SVG_METADATA, RE_SVG_EDITOR, RE_SVG_EDITOR_ATTRS):
+        svg = pattern.sub('', svg)
+    svg = RE_SVG_WHITESPACES.sub(lambda m: m.group(1) or '>', svg)
+    return svg.strip().encode('utf-8')
+
+
+def thumbnail(image, size):
+    '''Fit an image into a transparent square of `size` pixels and encode it as PNG'''
+    image = image.copy()
+    image.thumbnail((size, size), Image.LANCZOS)
+    canvas = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    canvas.paste(image, ((size - image.width) // 2, (size - image.height) // 2))
+    out = io.BytesIO()
+    canvas.save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+def store_asset(root, data, ext):
+    '''Store an asset by its content hash and return its relative path'''
+    digest = hashlib.sha256(data).hexdigest()
+    relpath = os.path.join(digest[:2], '{0}.{1}'.format(digest, ext))
+    filename = os.path.join(root, relpath)
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = '{0}.{1}.part'.format(filename, os.getpid())
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        os.replace(tmp, filename)
+    return relpath
+
+
+def derivatives_variants(filename, sizes=THUMBNAIL_SIZES):
+    '''The variants which can be built for a logo file with the installed dependencies'''
+    variants = set()
+    is_svg = filename.lower().endswith('.svg')
+    if is_svg:
+        variants.add('svg')
+    if not is_svg or cairosvg is not None:
+        variants.update('png{0}'.format(size) for size in sizes)
+    return variants
+
+
+def build_derivatives(source, root, sizes=THUMBNAIL_SIZES):
+    '''
+    Build the derivatives of a logo file:
+
+        - a minified SVG for SVG files
+        - a PNG thumbnail for each size (SVG files require CairoSVG)
+
+    Executed in worker processes: returns an `({variant: path}, error)` tuple.
+    '''
+    try:
+        with open(source, 'rb') as f:
+            data = f.read()
+        assets = {}
+        if source.lower().endswith('.svg'):
+            assets['svg'] = store_asset(root, minify_svg(data), 'svg')
+            if cairosvg is None:
+                return assets, None
+            data = cairosvg.svg2png(bytestring=data, output_width=max(sizes))
+        with Image.open(io.BytesIO(data)) as image:
+            image.seek(0)  # First frame of animated images
+            image = image.convert('RGBA')
+            for size in sizes:
+                assets['png{0}'.format(size)] = store_asset(root, thumbnail(image, size), 'png')
+        return assets, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def build_logos_derivatives(zones, dist_dir, workers=None, batch_size=50):
+    """
+    Build the derivatives of fetched logos with a pool of `workers` processes.
+
+    Derivatives are stored by content hash and a manifest maps
+    each logo source and each zone to its derivatives paths.
+    Derivatives of files whose hash did not change are not built again
+    unless some variants were missing (ex: SVG thumbnails built without CairoSVG).
+    """
+    if Image is None:
+        error('Logos derivatives require the optional `logos` dependencies (`pip install -e .[logos]`)')
+        return
+    if cairosvg is None:
+        warning('CairoSVG is not installed: SVG logos will not be rasterized')
+    path = os.path.join(dist_dir, LOGOS_FOLDER_PATH)
+    root = os.path.join(dist_dir, DERIVATIVES_FOLDER_PATH)
+    manifest_path = os.path.join(root, DERIVATIVES_MANIFEST)
+    os.makedirs(root, exist_ok=True)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f).get('sources', {})
+
+    logos = zones_logos(zones, batch_size)
+    sources = {}
+    pending = {}
+    for filename in set(logos.values()):
+        filepath = os.path.join(path, filename)
+        if not os.path.exists(filepath):
             continue
-        with open(filepath, 'wb') as out:
-            for chunk in r.iter_content(chunk_size=1024):
-                out.write(chunk)
-            downloaded += 1
-    logfile.close()
-    success('{0} logos fetched for {1} candidates', downloaded, count)
+        digest = file_sha256(filepath)
+        known = previous.get(filename)
+        is_current = (
+            known and known['sha256'] == digest
+            and derivatives_variants(filename) <= set(known['assets'])
+            and all(os.path.exists(os.path.join(root, asset)) for asset in known['assets'].values())
+        )
+        if is_current:
+            sources[filename] = known
+        else:
+            pending[filename] = digest
+    unchanged = len(sources)
+    info('{0} logos unchanged, building derivatives for {1}', unchanged, len(pending))
+
+    failed = 0
+    with ProcessPoolExecutor(workers) as pool:
+        futures = dict(
+            (pool.submit(build_derivatives, os.path.join(path, filename), root), filename)
+            for filename in pending
+        )
+        for future in progress(as_completed(futures), 'Building derivatives', length=len(futures)):
+            filename = futures[future]
+            assets, err = future.result()
+            if err:
+                warning('Unable to build derivatives for {0}: {1}', filename, err)
+                failed += 1
+                continue
+            sources[filename] = {'sha256': pending[filename], 'assets': assets}
+
+    tmp = manifest_path + '.part'
+    with open(tmp, 'w') as out:
+        json.dump({
+            'sources': sources,
+            'zones': dict(
+                (zone_id, sources[filename]['assets'])
+                for zone_id, filename in logos.items() if filename in sources
+            ),
+        }, out, indent=2, sort_keys=True)
+    os.replace(tmp, manifest_path)
+    success('Built derivatives for {0} logos ({1} unchanged, {2} failed)',
+            len(pending) - failed, unchanged, failed)
 
 
 def compress_logos(dist_dir):
@@ -67,5 +382,11 @@ def compress_logos(dist_dir):
     path = os.path.join(dist_dir, LOGOS_FOLDER_PATH)
     info('Compressing logos to {filename}', filename=filename)
     with tarfile.open(filename, 'w:xz') as txz:
-        txz.add(path, 'logos')
+        txz.add(path, 'logos', filter=_logo_files)
     success('Compressing done')
+
+
+def _logo_files(tarinfo):
+    '''Exclude the validators index and partial downloads from the archive'''
+    name = os.path.basename(tarinfo.name)
+    return None if name == LOGOS_INDEX or name.endswith('.part') else tarinfo
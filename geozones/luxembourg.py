@@ -1,4 +1,4 @@
-from . import wiki
+from . import wiki, wikidump
 from .model import Level, country
 from .tools import info, progress
 
@@ -62,12 +62,22 @@ WHERE {
 }
 '''
 
+DISTRICTS_SELECTION = wikidump.Selection('district', match=('iso', 'P300'), instance_of=['Q216888'], fields={
+    'geonames': 'P1566',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, wikipedia='frwiki')
+
 
 @district.postprocessor()
 def fetch_districts_data_from_wikidata(db):
     info('Fetching luxembourguish districts wikidata metadata')
-    results = wiki.data_sparql_query(DISTRICTS_SPARQL)
-    results = wiki.data_reduce_result(results, 'district')
+    results = wiki.data_query(DISTRICTS_SPARQL, DISTRICTS_SELECTION)
     for row in progress(results):
         iso = row['iso'].lower()
         db.update_zone(district.id, iso, db.TODAY,  ops={
@@ -140,12 +150,22 @@ WHERE {
 }
 '''
 
+CANTONS_SELECTION = wikidump.Selection('canton', match=('iso', 'P300'), instance_of=['Q1146429'], fields={
+    'geonames': 'P1566',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, wikipedia='frwiki')
+
 
 @canton.postprocessor()
 def fetch_cantons_data_from_wikidata(db):
     info('Fetching luxembourguish cantons wikidata metadata')
-    results = wiki.data_sparql_query(CANTONS_SPARQL)
-    results = wiki.data_reduce_result(results, 'canton')
+    results = wiki.data_query(CANTONS_SPARQL, CANTONS_SELECTION)
     for row in progress(results):
         iso = row['iso'].lower()
         db.update_zone(canton.id, iso, db.TODAY,  ops={
@@ -218,12 +238,22 @@ WHERE {
 }
 '''
 
+COMMUNES_SELECTION = wikidump.Selection('commune', match=('lau', 'P782'), instance_of=['Q2919801'], fields={
+    'geonames': 'P1566',
+    'area': 'P2046',
+    'population': 'P1082',
+    'flag': 'P41',
+    'blazon': 'P94',
+    'logo': 'P154',
+    'site': 'P856',
+    'osm': 'P402',
+}, wikipedia='frwiki')
+
 
 @commune.postprocessor()
 def fetch_communes_data_from_wikidata(db):
     info('Fetching luxembourguish communes wikidata metadata')
-    results = wiki.data_sparql_query(COMMUNES_SPARQL)
-    results = wiki.data_reduce_result(results, 'commune')
+    results = wiki.data_query(COMMUNES_SPARQL, COMMUNES_SELECTION)
     for row in progress(results):
         lau = row['lau'].lower()
         db.update_zone(commune.id, lau, db.TODAY,  ops={
@@ -1,16 +1,82 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import os
+import time
 import traceback
 
+from collections import OrderedDict, defaultdict
+from functools import partial
+from itertools import islice
 from os.path import join, basename
 
 from fiona.crs import to_string
-from shapely.geometry import shape, MultiPolygon
-from shapely.validation import explain_validity
 
-from .loaders import load
+from .db import BULK_SIZE, IndexedDB, with_validity_bounds
+from .geometry import iter_prepared, geometry_array, geometry_flags, geometry_hashes
+from .geometry import union_geometries
+from .topology import dissolve
+from .loaders import load, load_arrow, supports_arrow, ArrowCollection
 from .tools import warning, error, info, success, progress
-from .tools import aggregate_multipolygons, match_patterns
+from .tools import chunker, match_patterns, file_sha256, source_sha256
+
+# Number of features given at once to batch extractors
+EXTRACT_BATCH_SIZE = 1000
+# A loading checkpoint is saved every CHECKPOINT_SIZE features or CHECKPOINT_DELAY seconds
+CHECKPOINT_SIZE = 10000
+CHECKPOINT_DELAY = 60
+# Number of aggregated geometries kept in memory for reuse
+AGGREGATES_CACHE_SIZE = 32
+
+
+class GeometryError(Exception):
+    '''Raised when a geometry processing failed in a worker process'''
+    pass
+
+
+class AggregateCache(object):
+    '''
+    A LRU cache of aggregated geometries with their population and area sums.
+
+    Entries are keyed by their content: members identifiers and geometries hashes.
+    Aggregates identifiers are aliases to their last built entry
+    so they can be referenced as members by other aggregates.
+    '''
+    def __init__(self, size=AGGREGATES_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.aliases = {}
+
+    def key(self, content, grid_size=None):
+        '''Compute a content key from `(identifier, hash)` tuples'''
+        sha = hashlib.sha1(repr(grid_size).encode('utf-8'))
+        for zoneid, digest in sorted(content):
+            sha.update(zoneid.encode('utf-8'))
+            sha.update(digest.encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        '''Get an entry `(geom, population, area)` if cached'''
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def resolve(self, zoneid):
+        '''Get a `(key, entry)` tuple for an aggregate identifier if cached'''
+        key = self.aliases.get(zoneid)
+        entry = self.get(key) if key else None
+        return (key, entry) if entry else None
+
+    def set(self, key, entry, alias=None):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if alias:
+            self.aliases[alias] = key
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+AGGREGATES = AggregateCache()
 
 
 class Level(object):
@@ -29,23 +95,34 @@ class Level(object):
         self.extractors = []
         self.postprocessors = []
         self.aggregates = []
+        self.rollups = []
         for parent in parents:
             parent.children.append(self)
 
     def __str__(self):
         return self.id
 
-    def preprocessor(self, url=None, **kwargs):
+    def preprocessor(self, url=None, depends=None, requires=None, provides=None, **kwargs):
         '''
         Register a non geospatial dataset and its processor.
+
+        `depends` is an optional list of levels which need
+        to be preprocessed before this processor runs.
+
+        `requires` and `provides` are optional lists of resources names
+        (ex: `fr:commune:population`): a processor runs after
+        all the processors providing the resources it requires.
         '''
         def wrapper(func):
             func.kwargs = kwargs
+            func.depends = depends or []
+            func.requires = requires or []
+            func.provides = provides or []
             self.preprocessors.append((url, func))
             return func
         return wrapper
 
-    def extractor(self, url, simplify=None, **kwargs):
+    def extractor(self, url, simplify=None, index=None, batch=False, depends=None, **kwargs):
         '''
         Register a dataset and its extractor.
 
@@ -59,20 +136,48 @@ class Level(object):
 
         The simplify parameter is documented here (we use `0.005` for France):
         http://toblerity.org/shapely/manual.html#object.simplify
+
+        The index parameter allows to serve `db.zone()` and `db.level()` lookups
+        from an in-memory `ZoneIndex` for the current level (`True`)
+        or for a given list of levels.
+
+        The batch parameter registers a batch extractor with the following signature:
+        ``function(db, polygons)`` returning a list of zones (or `None`),
+        one for each given polygon.
+
+        `depends` is an optional list of levels which need to be loaded
+        before this extractor runs (parent levels are always loaded before).
         '''
         def wrapper(func):
             func.simplify = simplify
+            func.index = index
+            func.batch = batch
+            func.depends = depends or []
             func.kwargs = kwargs
             self.extractors.append((url, func))
             return func
         return wrapper
 
-    def postprocessor(self, url=None, **kwargs):
+    def postprocessor(self, url=None, depends=None, requires=None, provides=None, parallel=False, **kwargs):
         '''
         Register a non geospatial dataset and its processor.
+
+        `depends` is an optional list of levels which need
+        to be postprocessed before this processor runs.
+
+        `requires` and `provides` are optional lists of resources names
+        (ex: `fr:commune:population`): a processor runs after
+        all the processors providing the resources it requires.
+
+        A `parallel` processor is also given a `workers` keyword argument:
+        the size of the process pool it may use (`None` to run in-process).
         '''
         def wrapper(func):
             func.kwargs = kwargs
+            func.depends = depends or []
+            func.requires = requires or []
+            func.provides = provides or []
+            func.parallel = parallel
             self.postprocessors.append((url, func))
             return func
         return wrapper
@@ -90,9 +195,46 @@ class Level(object):
         filename = fn.kwargs.get('filename', os.path.basename(url))
         return os.path.join(self.id, filename)
 
+    def processors(self, step):
+        '''The `(url, processor)` list of a given step (`preprocess` or `postprocess`)'''
+        return {
+            'preprocess': self.preprocessors,
+            'postprocess': self.postprocessors,
+        }[step]
+
+    def dependencies(self, step):
+        '''
+        The identifiers of the levels which need to be processed
+        before this one for a given step (`preprocess` or `load`).
+
+        Parent levels are implicit dependencies.
+        '''
+        functions = self.extractors if step == 'load' else self.processors(step)
+        ids = set(p.id for p in self.parents)
+        for _, func in functions:
+            ids.update(getattr(level, 'id', level) for level in func.depends)
+        ids.discard(self.id)
+        return ids
+
     def aggregate(self, id, label, zones, **properties):
-        '''Register a aggregate for this level.'''
+        '''
+        Register a aggregate for this level.
+
+        Returns the aggregate identifier so it can be used
+        as a member of another aggregate.
+        '''
         self.aggregates.append((id, label, zones, properties))
+        return ':'.join((self.id, id))
+
+    def rollup(self, source, *fields, fallback=False):
+        '''
+        Declare some fields computed as the sum of the `source` level children ones.
+
+        With `fallback`, only zones without value for a field
+        (or with a value computed by a previous run) are updated.
+        Rollups are computed by `rollup.compute_rollups()`.
+        '''
+        self.rollups.append((source, fields, fallback))
 
     def traverse(self):
         '''Deep tree traversal.'''
@@ -104,10 +246,16 @@ class Level(object):
                     yield level
                     done.add(level.id)
 
-    def load(self, workdir, db, only=None, exclude=None):
+    def load(self, workdir, db, only=None, exclude=None, batch_size=BULK_SIZE, workers=None, arrow=False,
+             force=False, resume=False):
         '''
         Extract territories from a given file for a given level
         with a given extractor function.
+
+        Datasets whose file and extractor did not change since
+        their last load are skipped unless `force` is set.
+        Loading checkpoints are saved in the manifest and,
+        with `resume`, an interrupted load restarts from the last one.
         '''
         loaded = 0
         for url, extractor in self.extractors:
@@ -115,166 +263,386 @@ class Level(object):
                 continue
             if match_patterns(extractor.__name__, exclude):
                 continue
-            loaded += self.process_dataset(workdir, db, url, extractor)
+            filename = self.filename_for(url, extractor)
+            path = join(workdir, filename)
+            fingerprint = checkpoint = None
+            start = previous = 0
+            if os.path.exists(path):
+                entry = db.manifest.get(self.id, extractor.__name__, filename)
+                fingerprint = self.fingerprint(path, extractor, entry)
+                if not force and db.manifest.is_current(entry, fingerprint):
+                    info('Skipping unchanged dataset {0} for level {1} ({2} zones loaded on {3})',
+                         filename, self.id, entry.get('loaded'), entry.get('date'))
+                    if entry.get('mtime') != fingerprint['mtime']:
+                        # Same content downloaded again: avoid hashing it next time
+                        db.manifest.record(self.id, extractor.__name__, filename,
+                                           fingerprint, entry.get('loaded'), entry.get('date'))
+                    continue
+                last = (entry or {}).get('checkpoint')
+                if resume and db.manifest.is_current(last, fingerprint):
+                    start, previous = last['offset'], last['loaded']
+                    info('Resuming dataset {0} for level {1} after {2} features ({3} zones loaded)',
+                         filename, self.id, start, previous)
+                checkpoint = partial(db.manifest.checkpoint, self.id, extractor.__name__, filename, fingerprint)
+            count = previous + self.process_dataset(workdir, db, url, extractor,
+                                                    batch_size=batch_size, workers=workers, arrow=arrow,
+                                                    start=start, checkpoint=checkpoint, loaded=previous)
+            if fingerprint:
+                db.manifest.record(self.id, extractor.__name__, filename, fingerprint, count)
+            loaded += count
         success('Loaded {0} zones for level {1}', loaded, self.id)
         return loaded
 
-    def process_dataset(self, workdir, db, url, extractor):
+    def fingerprint(self, filename, extractor, entry=None):
+        '''
+        Compute a dataset fingerprint.
+
+        The file is only hashed if its size or modification time differ
+        from the ones recorded in the previous manifest `entry`.
+        '''
+        stat = os.stat(filename)
+        fingerprint = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'source': source_sha256(extractor),
+        }
+        if entry and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            fingerprint['sha256'] = entry.get('sha256')
+        else:
+            fingerprint['sha256'] = file_sha256(filename)
+        return fingerprint
+
+    def process_dataset(self, workdir, db, url, extractor, batch_size=BULK_SIZE, workers=None, arrow=False,
+                        start=0, checkpoint=None, loaded=0):
         '''
         Extract territories from a given file for a given level
         with a given extractor function.
+
+        Zones are upserted by batches of `batch_size`.
+        If `workers` is given, geometries are processed by a pool of
+        `workers` processes while the extractor is executed in the main one.
+        If `arrow` is set, supported files are read with pyogrio.
+
+        The first `start` features are skipped.
+        If given, `checkpoint(offset, loaded)` is called regularly once
+        all zones extracted from the first `offset` features are written,
+        `loaded` being the total number of zones written so far
+        (including the `loaded` ones from a previous run).
         '''
-        loaded = 0
         filename = join(workdir, self.filename_for(url, extractor))
         layer = getattr(extractor, 'layer', None)
+        index = getattr(extractor, 'index', None)
+        if index:
+            levels = [self.id] if index is True else [getattr(l, 'id', l) for l in index]
+            source = IndexedDB(db, levels)
+        else:
+            source = db
 
-        with load(filename, **extractor.kwargs) as collection:
+        if arrow and supports_arrow(filename):
+            loader = load_arrow
+        else:
+            loader = load
+
+        with loader(filename, **extractor.kwargs) as collection, db.bulk_writer(batch_size) as writer:
+            crs = getattr(collection, 'crs', None)
+            if crs is not None and not isinstance(crs, str):
+                crs = to_string(crs)
             if layer:
                 msg = '{0}/{1} ({2} {3})'.format(
-                     basename(filename), layer, collection.driver,
-                     to_string(collection.crs))
+                     basename(filename), layer, collection.driver, crs)
             elif hasattr(collection, 'driver'):
                 msg = '{0} ({1} {2})'.format(
-                     basename(filename), collection.driver,
-                     to_string(collection.crs))
+                     basename(filename), collection.driver, crs)
             else:
                 msg = '{0}'.format(basename(filename))
 
-            for polygon in progress(collection, msg):
+            if isinstance(collection, ArrowCollection):
+                features = progress(collection, msg, length=len(collection))
+            else:
+                features = progress(collection, msg)
+            if start:
+                features = islice(features, start, None)
+            features = iter_prepared(features, extractor.simplify, workers)
+            done, saved_at = start, time.monotonic()
+            for polygon, prepared, zone in self._extract(extractor, source, features):
+                if checkpoint and done > start and (
+                        (done - start) % CHECKPOINT_SIZE == 0
+                        or time.monotonic() - saved_at > CHECKPOINT_DELAY):
+                    # Zones extracted from the `done` first features are all queued
+                    writer.flush()
+                    checkpoint(done, loaded + writer.written)
+                    saved_at = time.monotonic()
+                done += 1
                 try:
-                    zone = extractor(db, polygon)
                     if not zone:
                         continue
                     zone['keys'] = dict(
                         (k, v)
                         for k, v in zone.get('keys', {}).items()
                         if v is not None)
-                    geom = shape(polygon['geometry'])
-                    if extractor.simplify:
-                        geom = geom.simplify(extractor.simplify)
-                    if geom.geom_type == 'Polygon':
-                        geom = MultiPolygon([geom])
-                    elif geom.geom_type != 'MultiPolygon':
+                    if isinstance(prepared, str):
+                        raise GeometryError(prepared)
+                    geom_type, geom, invalidity = prepared
+                    if not geom:
                         warning('Unsupported geometry type "{0}" for "{1}"',
-                                geom.geom_type, zone['name'])
+                                geom_type, zone['name'])
                         continue
-                    zone.update(geom=geom.__geo_interface__)
+                    zone.update(geom=geom)
                     zone_id = zone.get('_id')
                     if not zone_id:
                         zone_id = ':'.join((self.id, zone['code']))
                         if 'validity' in zone and zone['validity'].get('start'):
-                            start = zone['validity']['start']
-                            zone_id = '@'.join((zone_id, start))
+                            zone_id = '@'.join((zone_id, zone['validity']['start']))
 
-                    if not geom.is_valid:
-                        warning('Invalid geometry for "{0}": {1}', zone_id, explain_validity(geom))
+                    if invalidity:
+                        warning('Invalid geometry for "{0}": {1}', zone_id, invalidity)
 
                     zone.update(_id=zone_id, level=self.id)
-                    db.find_one_and_replace(
-                        {'_id': zone_id}, zone, upsert=True)
-                    loaded += 1
+                    writer.replace(with_validity_bounds(zone))
+                    if index:
+                        source.refresh(zone)
+                except GeometryError as e:
+                    props = dict(polygon.get('properties', {}))
+                    error('Error processing polygon {0} geometry:\n{1}', props, e)
                 except Exception:
                     props = dict(polygon.get('properties', {}))
                     error('Error extracting polygon {0}:\n{1}',
                           props, traceback.format_exc())
 
+        loaded = writer.written
         info('Loaded {0} zones for level {1} from file {2}',
              loaded, self.id, filename)
         return loaded
 
-    def build_aggregates(self, db):
+    def _extract(self, extractor, db, features):
+        '''
+        Execute an extractor on `(feature, prepared)` tuples
+        and iter over `(feature, prepared, zone)` tuples.
+
+        Batch extractors are called once for each chunk of `EXTRACT_BATCH_SIZE` features
+        and should return a list of zones (or `None`) in the same order.
+        A tuple is yielded for every feature, `zone` being `None` on failure.
+        '''
+        if not getattr(extractor, 'batch', False):
+            for polygon, prepared in features:
+                try:
+                    zone = extractor(db, polygon)
+                except Exception:
+                    props = dict(polygon.get('properties', {}))
+                    error('Error extracting polygon {0}:\n{1}',
+                          props, traceback.format_exc())
+                    zone = None
+                yield polygon, prepared, zone
+            return
+        for chunk in chunker(features, EXTRACT_BATCH_SIZE):
+            try:
+                zones = extractor(db, [polygon for polygon, _ in chunk])
+            except Exception:
+                error('Error extracting a batch of {0} polygons:\n{1}',
+                      len(chunk), traceback.format_exc())
+                zones = [None] * len(chunk)
+            for (polygon, prepared), zone in zip(chunk, zones):
+                yield polygon, prepared, zone
+
+    def build_aggregates(self, db, workers=None, grid_size=None):
         processed = 0
         for code, name, zones, properties in self.aggregates:
             info('Building aggregate "{0}" (level={1}, code={2})',
                  name, self.id, code)
             if callable(zones):
                 zones = zones(db)
-            zone = self.build_aggregate(code, name, zones, properties, db)
+            zone = with_validity_bounds(self.build_aggregate(code, name, zones, properties, db,
+                                                             workers=workers, grid_size=grid_size))
             db.find_one_and_replace({'_id': zone['_id']}, zone, upsert=True)
             processed += 1
         return processed
 
-    def build_aggregate(self, code, name, zones, properties, db):
+    def build_aggregate(self, code, name, zones, properties, db, workers=None, grid_size=None):
+        '''
+        Build an aggregate zone from its members identifiers.
+
+        `level:*` wildcards stand for all the zones of a level.
+        Members are fetched with a single query and their geometries are unioned
+        by `union_geometries()` (see for `workers` and `grid_size` usage).
+
+        Results are cached by content so aggregates referencing other
+        aggregates or sharing the same members reuse their unions.
+        '''
         geoid = ':'.join((self.id, code))
-        geoms = []
-        populations = []
-        areas = []
         if callable(zones):
             zones = [zone['_id'] for zone in zones(db)]
-        for zoneid in progress(zones, 'Building {}'.format(geoid)):
-            # Resolve wildcard
-            if zoneid.endswith(':*'):
-                level = zoneid.replace(':*', '')
-                ids = db.distinct('_id', {'level': level})
-                resolved = self.build_aggregate(
-                    code, name, ids, properties, db)
-                geoms.append(shape(resolved['geom']))
-                if resolved.get('population'):
-                    populations.append(resolved['population'])
-                if resolved.get('area'):
-                    areas.append(resolved['area'])
-            else:
-                zone = db.find_one({'_id': zoneid})
-                if not zone:
-                    warning('Zone {0} not found'.format(zoneid))
-                    continue
-                if 'geom' not in zone:
-                    warning('Zone {0} without geometry'.format(zone['name']))
-                    continue
-                shp = shape(zone['geom'])
-                if not shp.is_valid:
-                    warning(('Skipping invalid polygon for {0}'
-                             '').format(zone['name']))
-                    continue
-                if shp.is_empty:
-                    warning('Skipping empty polygon for {0}', zone['name'])
-                    continue
-                geoms.append(shp)
-                if zone.get('population'):
-                    populations.append(zone['population'])
-                if zone.get('area'):
-                    areas.append(zone['area'])
-
-        if geoms:
-            geom = aggregate_multipolygons(geoms).__geo_interface__
+        ids = [zoneid for zoneid in zones if not zoneid.endswith(':*')]
+        wildcards = [zoneid[:-2] for zoneid in zones if zoneid.endswith(':*')]
+        # Aggregates built during this run are not fetched again
+        references = dict((zoneid, AGGREGATES.resolve(zoneid)) for zoneid in ids)
+        references = dict((zoneid, ref) for zoneid, ref in references.items() if ref)
+        ids = [zoneid for zoneid in ids if zoneid not in references]
+        query = {'$or': [{'_id': {'$in': ids}}, {'level': {'$in': wildcards}}]}
+        projection = {'level': True, 'name': True, 'geom': True, 'population': True, 'area': True}
+        found = dict((zone['_id'], zone) for zone in db.find(query, projection))
+        members = []
+        for zoneid in ids:
+            if zoneid not in found:
+                warning('Zone {0} not found'.format(zoneid))
+                continue
+            members.append(found.pop(zoneid))
+        # Remaining zones have been resolved from wildcards
+        members.extend(found.values())
+        for zone in [zone for zone in members if 'geom' not in zone]:
+            warning('Zone {0} without geometry'.format(zone['name']))
+            members.remove(zone)
+
+        # Geometries are checked at once (vectorized with Shapely 2)
+        shapes = geometry_array([zone['geom'] for zone in members])
+        valid = []
+        for zone, shp, is_valid, is_empty in zip(members, shapes, *geometry_flags(shapes)):
+            if not is_valid:
+                warning(('Skipping invalid polygon for {0}'
+                         '').format(zone['name']))
+                continue
+            if is_empty:
+                warning('Skipping empty polygon for {0}', zone['name'])
+                continue
+            valid.append((zone, shp))
+
+        digests = geometry_hashes([shp for _, shp in valid])
+        content = [(zone['_id'], digest) for (zone, _), digest in zip(valid, digests)]
+        content.extend((zoneid, key) for zoneid, (key, _) in references.items())
+        key = AGGREGATES.key(content, grid_size)
+        cached = AGGREGATES.get(key)
+        if cached:
+            info('Reusing cached union for {0}', geoid)
+            geom, population, area = cached
         else:
-            geom = None
-            warning('No geometry for {0}', zones)
+            geoms = [shp for _, shp in valid]
+            populations = [zone['population'] for zone, _ in valid if zone.get('population')]
+            areas = [zone['area'] for zone, _ in valid if zone.get('area')]
+            for _, (geom, population, area) in references.values():
+                geoms.append(geom)
+                populations.append(population)
+                areas.append(area)
+            member_levels = set(zone.get('level') for zone, _ in valid)
+            if geoms and not references and len(member_levels) == 1:
+                # Members from a single level can be dissolved using its topology
+                info('Dissolving {0} zones for {1}', len(geoms), geoid)
+                geom = dissolve(member_levels.pop(), [zone['_id'] for zone, _ in valid], geoms,
+                                digests, workers, grid_size)
+            elif geoms:
+                info('Union of {0} geometries for {1}', len(geoms), geoid)
+                geom = union_geometries(geoms, workers, grid_size)
+            else:
+                geom = None
+                warning('No geometry for {0}', zones)
+            population, area = sum(populations), sum(areas)
+        if geom is not None:
+            AGGREGATES.set(key, (geom, population, area), geoid)
 
         data = {
             '_id': geoid,
             'code': code,
             'level': self.id,
             'name': name,
-            'population': sum(populations),
-            'area': sum(areas),
-            'geom': geom
+            'population': population,
+            'area': area,
+            'geom': geom.__geo_interface__ if geom is not None else None
         }
         data.update(properties)
         return data
 
-    def preprocess(self, workdir, db, only=None, exclude=None):
-        '''Perform preprocessing.'''
-        self._process(self.preprocessors, workdir, db, only=only, exclude=exclude)
+    def run_processor(self, step, name, workdir, db, workers=None):
+        '''
+        Execute a single processor of a given step by its name.
 
-    def postprocess(self, workdir, db, only=None, exclude=None):
-        '''Perform postprocessing.'''
-        self._process(self.postprocessors, workdir, db, only=only, exclude=exclude)
+        `workers` is given to parallel processors.
+        '''
+        url, processor = next((u, p) for u, p in self.processors(step) if p.__name__ == name)
+        self._execute(url, processor, workdir, db, workers)
+
+    def _execute(self, url, processor, workdir, db, workers=None):
+        kwargs = {'workers': workers} if getattr(processor, 'parallel', False) else {}
+        if url:
+            filename = self.filename_for(url, processor)
+            filename = os.path.join(workdir, filename)
+            with load(filename, **processor.kwargs) as collection:
+                processor(db, collection, **kwargs)
+        else:
+            processor(db, **kwargs)
 
-    def _process(self, lst, workdir, db, only=None, exclude=None):
-        '''Perform postprocessing.'''
-        for url, processor in lst:
-            if only is not None and processor.__name__ != only:
-                continue
-            if match_patterns(processor.__name__, exclude):
-                continue
-            if url:
-                filename = self.filename_for(url, processor)
-                filename = os.path.join(workdir, filename)
-                with load(filename, **processor.kwargs) as collection:
-                    processor(db, collection)
-            else:
-                processor(db)
+
+def processor_key(level, processor):
+    '''The unique identifier of a level processor'''
+    return ':'.join((level.id, processor.__name__))
+
+
+def processors_graph(step, levels, only=None, exclude=None, requirements=False):
+    '''
+    Get the processors of a step with their requirements.
+
+    A processor requires:
+
+        - the processors providing the resources it `requires`
+        - all the processors of the levels it `depends` on
+        - for the `preprocess` step only, the preprocessors of its parent levels
+          and the previous ones of its own level (they are not declarative)
+
+    Returns a `{key: (level, processor, requirements)}` ordered dict
+    for the processors of the given `levels` in their declaration order.
+    With `only`, only the given processor is returned
+    or, with `requirements`, along with all its transitive requirements, whatever their level.
+    Processors or levels matching `exclude` patterns are never returned.
+    '''
+    entries = OrderedDict()
+    providers = defaultdict(set)
+    by_level = defaultdict(list)
+    for level in root.traverse():
+        for _, processor in level.processors(step):
+            key = processor_key(level, processor)
+            entries[key] = (level, processor)
+            by_level[level.id].append(key)
+            for resource in processor.provides:
+                providers[resource].add(key)
+
+    graph = OrderedDict()
+    for key, (level, processor) in entries.items():
+        required = set()
+        for resource in processor.requires:
+            if resource not in providers:
+                warning('No processor provides "{0}" required by {1}', resource, key)
+            required.update(providers[resource])
+        for dependency in processor.depends:
+            required.update(by_level[getattr(dependency, 'id', dependency)])
+        if step == 'preprocess':
+            for parent in level.parents:
+                required.update(by_level[parent.id])
+            siblings = by_level[level.id]
+            required.update(siblings[:siblings.index(key)])
+        required.discard(key)
+        graph[key] = (level, processor, required)
+
+    exclude = exclude or []
+
+    def is_excluded(key):
+        level, processor, _ = graph[key]
+        return match_patterns(processor.__name__, exclude) or match_patterns(level.id, exclude)
+
+    ids = set(level.id for level in levels)
+    if only is None:
+        selected = set(key for key, (level, _, _) in graph.items() if level.id in ids)
+    else:
+        selected = set(key for key, (level, processor, _) in graph.items()
+                       if level.id in ids and processor.__name__ == only)
+        pending = list(selected) if requirements else []
+        while pending:
+            key = pending.pop()
+            for requirement in graph[key][2] - selected:
+                if not is_excluded(requirement):
+                    info('Including {0} required by {1}', requirement, key)
+                    selected.add(requirement)
+                    pending.append(requirement)
+    return OrderedDict(
+        (key, entry) for key, entry in graph.items()
+        if key in selected and not is_excluded(key)
+    )
 
 
 # Force translatables string extraction
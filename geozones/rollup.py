@@ -0,0 +1,92 @@
+'''
+Hierarchical rollups
+
+Levels declare fields computed as the sum of their children ones
+(see `Level.rollup()`). All rollups are computed in memory in a single pass:
+zones are loaded once and rollups are processed bottom-up
+so a rollup always sums values already rolled up.
+
+Fallback rollups mark the fields they computed in `ROLLUPS_FIELD`
+so they are computed again by the next runs.
+Processors setting those fields should pull them from `ROLLUPS_FIELD`.
+'''
+from collections import defaultdict
+
+from pymongo import UpdateOne
+
+from .tools import info, success
+
+ROLLUPS_FIELD = '_rollups'
+
+
+def rollups_order(levels):
+    '''
+    Sort the `(level, source, fields, fallback)` rollups of some levels
+    so that rollups summing a level come after the ones computing it.
+    '''
+    pending = [(level, source, fields, fallback)
+               for level in levels for source, fields, fallback in level.rollups]
+    ordered = []
+    while pending:
+        ready = [r for r in pending if not any(o[0].id == r[1].id for o in pending if o is not r)]
+        if not ready:
+            raise ValueError('Circular rollups between: {0}'.format(
+                ', '.join(level.id for level, *_ in pending)))
+        for rollup in ready:
+            pending.remove(rollup)
+            ordered.append(rollup)
+    return ordered
+
+
+def compute_rollups(db, levels):
+    '''
+    Compute the rollups declared on some levels and write them in bulk.
+
+    Returns the number of updated zones.
+    '''
+    rollups = rollups_order(levels)
+    ids = set()
+    fields = set()
+    for level, source, names, _ in rollups:
+        ids.update((level.id, source.id))
+        fields.update(names)
+    projection = dict.fromkeys(('level', 'parents', ROLLUPS_FIELD) + tuple(fields), True)
+    info('Loading {0} zones', ', '.join(sorted(ids)))
+    zones = dict((zone['_id'], zone) for zone in db.find({'level': {'$in': list(ids)}}, projection))
+
+    updates = defaultdict(dict)
+    computed = defaultdict(set)
+    for level, source, names, fallback in rollups:
+        sums = defaultdict(dict)
+        for zone in zones.values():
+            if zone['level'] != source.id:
+                continue
+            for parent_id in zone.get('parents', []):
+                parent = zones.get(parent_id)
+                if not parent or parent['level'] != level.id:
+                    continue
+                for name in names:
+                    if zone.get(name):
+                        sums[parent_id][name] = sums[parent_id].get(name, 0) + zone[name]
+        processed = 0
+        for parent_id, values in sums.items():
+            parent = zones[parent_id]
+            if fallback:
+                # Values provided by other processors take precedence over computed ones
+                provided = set(k for k in values if parent.get(k)) - set(parent.get(ROLLUPS_FIELD, []))
+                values = dict((k, v) for k, v in values.items() if k not in provided)
+                computed[parent_id].update(values)
+            if values:
+                parent.update(values)
+                updates[parent_id].update(values)
+                processed += 1
+        success('Computed {0} for {1} {2} zones from {3}',
+                ', '.join(names), processed, level.id, source.id)
+
+    with db.bulk_writer() as writer:
+        for zone_id, values in updates.items():
+            update = {'$set': values}
+            if computed[zone_id]:
+                update['$addToSet'] = {ROLLUPS_FIELD: {'$each': sorted(computed[zone_id])}}
+            writer.write(UpdateOne({'_id': zone_id}, update))
+    return len(updates)
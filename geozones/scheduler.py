@@ -0,0 +1,120 @@
+'''
+Concurrent jobs scheduling
+'''
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .tools import info, error, disable_progress
+
+
+class SchedulingError(Exception):
+    '''Raised when a job failed or when dependencies can't be satisfied'''
+    pass
+
+
+class Scheduler(object):
+    '''
+    Run jobs in a pool of `workers` processes honoring their dependencies.
+
+    Jobs are identified by a unique key and only depend on other jobs keys.
+    Dependencies on unknown keys are ignored
+    so a subset of the full graph can be scheduled.
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = OrderedDict()
+
+    def add(self, key, func, *args, requires=None, **kwargs):
+        '''Register a job executing `func(*args, **kwargs)`'''
+        self.jobs[key] = (func, args, kwargs, set(requires or []))
+
+    def requirements(self, key):
+        '''The known requirements of a given job'''
+        return self.jobs[key][3] & set(self.jobs) - {key}
+
+    def order(self):
+        '''
+        Sort jobs keys topologically.
+
+        Jobs without dependencies between them keep their declaration order.
+        '''
+        done = []
+        pending = list(self.jobs)
+        while pending:
+            key = next((k for k in pending if self.requirements(k) <= set(done)), None)
+            if key is None:
+                raise SchedulingError('Circular dependencies between: {0}'.format(', '.join(pending)))
+            pending.remove(key)
+            done.append(key)
+        return done
+
+    def run(self):
+        '''
+        Execute all jobs and return their results by key.
+
+        On failure, no more job is started, running jobs are awaited
+        and a `SchedulingError` is raised.
+        '''
+        pending = self.order()
+        total = len(pending)
+        results = OrderedDict()
+        running = {}
+        failures = []
+        info('Running {0} jobs with {1} workers', total, self.workers)
+        with ProcessPoolExecutor(self.workers, initializer=disable_progress) as pool:
+            while pending or running:
+                ready = [k for k in pending if self.requirements(k) <= set(results)]
+                for key in ready:
+                    func, args, kwargs, _ = self.jobs[key]
+                    running[pool.submit(func, *args, **kwargs)] = key
+                    pending.remove(key)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    try:
+                        results[key] = future.result()
+                    except Exception as e:
+                        error('Job {0} failed: {1}', key, e)
+                        failures.append(key)
+                    else:
+                        info('[{0}/{1}] {2} done', len(results), total, key)
+                if failures:
+                    # Stop scheduling new jobs, only wait for the running ones
+                    pending = []
+        if failures:
+            raise SchedulingError('Failed jobs: {0}'.format(', '.join(failures)))
+        return results
+
+
+def _level(level_id):
+    from . import international, france, luxembourg  # noqa: Ensure all levels are registered
+    from .model import root
+    return next(l for l in root.traverse() if l.id == level_id)
+
+
+def level_job(mongo, config, method, level_id, workdir, *args, **kwargs):
+    '''
+    Execute a level method in a worker process.
+
+    The worker process uses its own database connection
+    and applies the given Wikidata `config` (see `wiki.configuration()`).
+    '''
+    from . import wiki
+    from .db import DB
+    wiki.configure(config)
+    return getattr(_level(level_id), method)(workdir, DB(mongo), *args, **kwargs)
+
+
+def processor_job(mongo, config, step, level_id, name, workdir, workers=None):
+    '''
+    Execute a single level processor in a worker process.
+
+    The worker process uses its own database connection
+    and applies the given Wikidata `config` (see `wiki.configuration()`).
+    '''
+    from . import wiki
+    from .db import DB
+    wiki.configure(config)
+    return _level(level_id).run_processor(step, name, workdir, DB(mongo), workers)
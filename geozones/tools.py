@@ -1,5 +1,6 @@
 import csv
 import fnmatch
+import hashlib
 import inspect
 import io
 
@@ -58,7 +59,19 @@ def ok(text):
         success()
 
 
+# Progress bars are disabled in worker processes
+_PROGRESS = {'enabled': True}
+
+
+def disable_progress():
+    '''Disable progress bars (ie. in worker processes)'''
+    _PROGRESS['enabled'] = False
+
+
 def progress(collection, msg=None, length=True):
+    if not _PROGRESS['enabled']:
+        yield from collection
+        return
     label = ' '.join((PROGRESS, msg)) if msg else PROGRESS
     kwargs = {'label': label, 'width': 0, 'fill_char': PROGRESS_FILL_CHAR}
     if length is True and (inspect.isgenerator(collection) or isinstance(collection, Iterator)):
@@ -119,6 +132,28 @@ def iter_over_cog(zipname, filename):
                 yield row
 
 
+def file_sha256(filename, block_size=2 ** 20):
+    '''Compute a file SHA-256 hexdigest without loading it in memory'''
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def source_sha256(func):
+    '''
+    Compute a SHA-256 hexdigest of a function source code.
+
+    Decorators are part of the source so their parameters are taken into account.
+    '''
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__qualname__
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
 def geom_to_multipolygon(geom):
     '''Cast a raw geometry to a Polygon or a MultiPolygon'''
     polygon = shape(geom)
@@ -0,0 +1,259 @@
+'''
+Shared arcs topology
+
+Zones of a level are decomposed into arcs (TopoJSON-style):
+borders shared by adjacent zones are stored once and referenced by both.
+Dissolving adjacent zones is then a matter of dropping their internal arcs
+and chaining the remaining ones instead of a full polygon overlay.
+
+Topologies are stored as TopoJSON files and are only used
+for zones whose geometries did not change since they have been built.
+'''
+import json
+import os
+
+from collections import defaultdict
+
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.geometry.polygon import orient
+
+from .geometry import geometry_array, geometry_hashes, union_geometries
+from .tools import info, warning
+
+TOPOLOGY_DIR = 'topology'
+
+# Loaded topologies by level
+_TOPOLOGIES = {}
+# Levels whose outdated topology has already been reported
+_OUTDATED = set()
+
+
+class TopologyError(Exception):
+    '''Raised when zones can't be dissolved using a topology'''
+    pass
+
+
+class Topology(object):
+    '''
+    A set of arcs and zones referencing them.
+
+    Each zone is stored as a list of polygons, each polygon being a list of rings
+    and each ring a list of arc references following the TopoJSON convention:
+    `i` for the i-th arc and `~i` for the i-th arc reversed.
+    Exterior rings are counter-clockwise and holes clockwise.
+    '''
+    def __init__(self, level, arcs=None, zones=None, hashes=None):
+        self.level = level
+        self.arcs = arcs or []
+        self.zones = zones or {}
+        self.hashes = hashes or {}
+
+    @classmethod
+    def from_geometries(cls, level, items):
+        '''Build a topology from `(id, hash, geometry)` tuples'''
+        items = list(items)
+        rings = {}
+        neighbours = defaultdict(set)
+        for zoneid, _, geom in items:
+            polygons = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+            rings[zoneid] = [
+                [list(ring.coords) for ring in (p.exterior, *p.interiors)]
+                for p in (orient(p) for p in polygons)
+            ]
+            for polygon in rings[zoneid]:
+                for ring in polygon:
+                    for previous, point, following in zip(ring[-2:-1] + ring[:-2], ring[:-1], ring[1:]):
+                        neighbours[point].update((previous, following))
+        # Arcs are cut where more than two borders meet
+        junctions = set(point for point, points in neighbours.items() if len(points) > 2)
+        del neighbours
+
+        topology = cls(level, hashes=dict((zoneid, digest) for zoneid, digest, _ in items))
+        index = {}
+        for zoneid, polygons in rings.items():
+            topology.zones[zoneid] = [
+                [[topology._arc(index, arc) for arc in _cut(ring, junctions)] for ring in polygon]
+                for polygon in polygons
+            ]
+        return topology
+
+    def _arc(self, index, coords):
+        '''Get the reference of an arc, registering it if needed'''
+        key = tuple(coords)
+        if key in index:
+            return index[key]
+        reversed_key = key[::-1]
+        if reversed_key in index:
+            return ~index[reversed_key]
+        index[key] = len(self.arcs)
+        self.arcs.append(coords)
+        return index[key]
+
+    def coords(self, ref):
+        '''Get the coordinates of an arc reference'''
+        return self.arcs[ref] if ref >= 0 else self.arcs[~ref][::-1]
+
+    def covers(self, content):
+        '''Wether all `(id, hash)` tuples are known and up to date'''
+        return all(self.hashes.get(zoneid) == digest for zoneid, digest in content)
+
+    def dissolve(self, ids):
+        '''
+        Dissolve some zones into a single MultiPolygon.
+
+        Arcs shared by two of the zones are dropped and
+        the remaining ones are chained into exterior rings and holes.
+        '''
+        usage = defaultdict(int)
+        refs = []
+        for zoneid in ids:
+            for polygon in self.zones[zoneid]:
+                for ring in polygon:
+                    for ref in ring:
+                        usage[ref if ref >= 0 else ~ref] += 1
+                        refs.append(ref)
+        outgoing = defaultdict(list)
+        for ref in refs:
+            if usage[ref if ref >= 0 else ~ref] == 1:
+                coords = self.coords(ref)
+                outgoing[coords[0]].append(coords)
+
+        exteriors, holes = [], []
+        while outgoing:
+            start = next(iter(outgoing))
+            ring = []
+            point = start
+            while True:
+                arcs = outgoing.get(point)
+                if not arcs:
+                    raise TopologyError('Unable to close a ring at {0}'.format(point))
+                coords = arcs.pop()
+                if not arcs:
+                    del outgoing[point]
+                ring.extend(coords if not ring else coords[1:])
+                point = coords[-1]
+                if point == start:
+                    break
+            if len(ring) < 4:
+                continue
+            if _signed_area(ring) > 0:
+                exteriors.append(Polygon(ring))
+            else:
+                holes.append(Polygon(ring))
+
+        interiors = [[] for _ in exteriors]
+        for hole in holes:
+            containers = [i for i, exterior in enumerate(exteriors) if exterior.contains(hole)]
+            if not containers:
+                raise TopologyError('Orphan hole')
+            smallest = min(containers, key=lambda i: exteriors[i].area)
+            interiors[smallest].append(hole.exterior.coords)
+        result = MultiPolygon([
+            Polygon(exterior.exterior.coords, rings)
+            for exterior, rings in zip(exteriors, interiors)
+        ])
+        if result.is_empty or not result.is_valid:
+            raise TopologyError('Dissolved geometry is not valid')
+        return result
+
+    def to_topojson(self):
+        return {
+            'type': 'Topology',
+            'arcs': self.arcs,
+            'objects': {
+                self.level: {
+                    'type': 'GeometryCollection',
+                    'geometries': [{
+                        'type': 'MultiPolygon',
+                        'id': zoneid,
+                        'properties': {'hash': self.hashes[zoneid]},
+                        'arcs': polygons,
+                    } for zoneid, polygons in self.zones.items()]
+                }
+            }
+        }
+
+    @classmethod
+    def from_topojson(cls, data):
+        level, collection = next(iter(data['objects'].items()))
+        topology = cls(level, arcs=[[tuple(point) for point in arc] for arc in data['arcs']])
+        for geometry in collection['geometries']:
+            topology.zones[geometry['id']] = geometry['arcs']
+            topology.hashes[geometry['id']] = geometry['properties']['hash']
+        return topology
+
+    def save(self, filename):
+        with open(filename, 'w') as out:
+            json.dump(self.to_topojson(), out)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_topojson(json.load(f))
+
+
+def _cut(ring, junctions):
+    '''Cut a closed ring into arcs at the given junctions'''
+    points = ring[:-1]
+    cuts = [i for i, point in enumerate(points) if point in junctions]
+    if not cuts:
+        # Isolated ring: start at its lowest point so a shared one is always cut the same way
+        start = points.index(min(points))
+        return [points[start:] + points[:start + 1]]
+    points = points[cuts[0]:] + points[:cuts[0]] + [points[cuts[0]]]
+    cuts = [i - cuts[0] for i in cuts] + [len(points) - 1]
+    return [points[start:end + 1] for start, end in zip(cuts, cuts[1:])]
+
+
+def _signed_area(ring):
+    '''Shoelace formula: positive for counter-clockwise rings'''
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:])) / 2
+
+
+def filename_for(level):
+    return os.path.join(TOPOLOGY_DIR, '{0}.topojson'.format(level.replace(':', '-')))
+
+
+def build_topology(db, level, at=None):
+    '''Build and store the topology of a level zones valid at a given date'''
+    zones = [zone for zone in db.level(level, at) if zone.get('geom')]
+    shapes = geometry_array([zone['geom'] for zone in zones])
+    items = zip([zone['_id'] for zone in zones], geometry_hashes(shapes), shapes)
+    topology = Topology.from_geometries(level, items)
+    if not os.path.exists(TOPOLOGY_DIR):
+        os.makedirs(TOPOLOGY_DIR)
+    topology.save(filename_for(level))
+    _TOPOLOGIES[level] = topology
+    _OUTDATED.discard(level)
+    return topology
+
+
+def topology_for(level):
+    '''Get the stored topology of a level if any'''
+    if level not in _TOPOLOGIES:
+        filename = filename_for(level)
+        _TOPOLOGIES[level] = Topology.load(filename) if os.path.exists(filename) else None
+        _OUTDATED.discard(level)
+    return _TOPOLOGIES[level]
+
+
+def dissolve(level, ids, shapes, digests=None, workers=None, grid_size=None):
+    '''
+    Dissolve zones of a level given their identifiers and geometries.
+
+    The level topology is used when all zones are part of it and unchanged,
+    otherwise (or on failure) geometries are unioned by `union_geometries()`.
+    '''
+    topology = topology_for(level)
+    if topology is not None and not grid_size:
+        if digests is None:
+            digests = geometry_hashes(shapes)
+        if topology.covers(zip(ids, digests)):
+            try:
+                return topology.dissolve(ids)
+            except TopologyError as e:
+                warning('Unable to dissolve {0} zones using topology: {1}', level, e)
+        elif level not in _OUTDATED:
+            info('Topology for {0} is outdated, falling back on union', level)
+            _OUTDATED.add(level)
+    return union_geometries(shapes, workers, grid_size)
@@ -4,11 +4,19 @@ WikiPedia/Data helpers
 import re
 import json
 import itertools
+import os
+import random
+import threading
+import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 from urllib.parse import quote, unquote
 
-from . import http
-from .tools import error
+from . import cache as caching
+from . import http, wikidump
+from .tools import error, warning
 
 RE_WIKIPEDIA = re.compile(r'https?://(?P<namespace>\w+)?\.?wikipedia\.org/wiki/(?P<path>.+)$')
 RE_DBPEDIA = re.compile(r'https?://(?P<namespace>\w+)?\.?dbpedia\.org/resource/(?P<path>.+)$')
@@ -18,6 +26,23 @@ WIKIDATA_SPARQL = 'https://query.wikidata.org/sparql'
 WD = 'http://www.wikidata.org/entity/'
 SAFE_CHARS = '!$()*,-./:;@_'  # See: https://www.mediawiki.org/wiki/Manual:PAGENAMEE_encoding
 
+# Wikidata query service etiquette: at most 5 parallel queries by client
+# See: https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits
+SPARQL_CONCURRENCY = 4
+# Maximum number of queries sent by second (on average)
+SPARQL_RATE = 2
+SPARQL_RETRIES = 5
+SPARQL_BACKOFF = 2  # Base delay in seconds, doubled on each retry
+SPARQL_TIMEOUT = 90
+# Chunks sizes grow while queries respond in less than SPARQL_TARGET_LATENCY seconds
+SPARQL_TARGET_LATENCY = 20
+SPARQL_CHUNK_GROWTH = 1.25
+SPARQL_MAX_CHUNK_SIZE = 1000
+SPARQL_HEADERS = {
+    'User-Agent': 'geozones/1.0 (http://github.com/etalab/geozones)',
+    'Accept': 'application/sparql-results+json',
+}
+
 
 def wikipedia_to_dbpedia(uri):
     '''Extract a DBPedia URI from a Wikipedia identifier or URL'''
@@ -79,33 +104,373 @@ def data_uri_to_id(uri):
     return uri.replace(WD, '') if uri else None
 
 
+class TokenBucket(object):
+    '''
+    A thread-safe token bucket rate limiter.
+
+    Allows `rate` acquisitions by second on average with bursts up to `capacity`.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait for a token to be available and consume it'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class SparqlError(Exception):
+    '''Raised when a SPARQL query failed despite retries'''
+    pass
+
+
+class CacheMiss(SparqlError):
+    '''Raised when a SPARQL query is not found in a readonly responses cache'''
+    pass
+
+
+class AdaptiveBatcher(object):
+    '''
+    Size chunks of items sent in a single SPARQL query from the observed response times.
+
+    The size grows while responses take less than `target` seconds
+    and is halved on failure. The learned size and the layout of the queried chunks
+    are persisted into the `state` JSON file (by `name`) to be reused by the next runs.
+
+    A `replay` batcher first gives chunks following the previous run layout
+    so the same items produce the same queries as the cached ones,
+    then gives chunks of the learned size.
+    '''
+    def __init__(self, name, size, target=SPARQL_TARGET_LATENCY,
+                 minimum=1, maximum=SPARQL_MAX_CHUNK_SIZE, state=None, replay=False):
+        self.name = name
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.state = state
+        self.lock = threading.Lock()
+        saved = self._load()
+        self.size = saved.get('size') or size
+        self.layout = deque(saved.get('layout', []) if replay else [])
+        # Sizes of the queried chunks by offset
+        self.chunks = {}
+
+    def _load(self):
+        if not self.state or not os.path.exists(self.state):
+            return {}
+        with open(self.state) as f:
+            saved = json.load(f).get(self.name)
+        # Previous states only kept the size
+        return saved if isinstance(saved, dict) else {'size': saved}
+
+    def next_size(self):
+        '''Get the size of the next chunk'''
+        return self.layout.popleft() if self.layout else self.size
+
+    def record(self, offset, size):
+        '''Record the `size` items chunk queried at `offset`'''
+        self.chunks[offset] = size
+
+    def save(self):
+        '''Persist the learned chunk size and the queried chunks layout'''
+        if not self.state:
+            return
+        layout, position = [], 0
+        for offset, size in sorted(self.chunks.items()):
+            # Items which failed alone are queried again one by one
+            layout.extend([1] * (offset - position))
+            layout.append(size)
+            position = offset + size
+        sizes = {}
+        if os.path.exists(self.state):
+            with open(self.state) as f:
+                sizes = json.load(f)
+        sizes[self.name] = {'size': self.size, 'layout': layout}
+        with open(self.state, 'w') as out:
+            json.dump(sizes, out)
+
+    def success(self, latency):
+        '''Grow the chunk size if the response time is under the target'''
+        with self.lock:
+            if latency < self.target:
+                self.size = min(self.maximum, int(self.size * SPARQL_CHUNK_GROWTH) + 1)
+
+    def failure(self):
+        '''Halve the chunk size'''
+        with self.lock:
+            self.size = max(self.minimum, self.size // 2)
+
+
+class SparqlClient(object):
+    '''
+    A Wikidata SPARQL client.
+
+    Queries are sent through a persistent connections pool
+    by up to `concurrency` threads, at most `rate` queries by second.
+    Throttled (429), failed (5xx) and timed out queries are retried
+    with a jittered exponential backoff, honoring `Retry-After` if given.
+    Responses are stored into an optional `ResponseCache`.
+    '''
+    def __init__(self, concurrency=SPARQL_CONCURRENCY, rate=SPARQL_RATE, retries=SPARQL_RETRIES,
+                 endpoint=WIKIDATA_SPARQL, cache=None):
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retries = retries
+        self.endpoint = endpoint
+        self.bucket = TokenBucket(rate, capacity=concurrency)
+        # Retries are handled by the client itself
+        self.session = http.session(retry=0, pool_size=concurrency)
+
+    def query(self, query):
+        '''Execute a SPARQL query and returns a list of n-uplets.'''
+        try:
+            results, _ = self._cached_query(query)
+            return results
+        except SparqlError as e:
+            error('SPARQL query failed: {0}', e)
+            return []
+
+    def _cached_query(self, query, retries=None):
+        '''
+        Execute a SPARQL query using the cache if any.
+
+        Returns a `(results, cached)` tuple and raises `SparqlError` on failure.
+        '''
+        if self.cache is None:
+            return self._query(query, retries), False
+        key = self.cache.key(self.endpoint, query)
+        results = self.cache.get(key)
+        if results is not None:
+            return results, True
+        elif self.cache.offline:
+            raise CacheMiss('Query {0} not found in cache'.format(key))
+        results = self._query(query, retries)
+        self.cache.set(key, results)
+        return results, False
+
+    def _query(self, query, retries=None):
+        '''
+        Execute a SPARQL query.
+
+        Timeouts and server errors are retried `retries` times
+        while throttled queries are always retried up to `self.retries` times.
+        '''
+        retries = self.retries if retries is None else retries
+        parameters = {
+            'query': query,
+            'format': 'json'
+        }
+        failures = throttles = 0
+        while True:
+            self.bucket.acquire()
+            retry_after = None
+            try:
+                response = self.session.post(self.endpoint, data=parameters, headers=SPARQL_HEADERS,
+                                             timeout=SPARQL_TIMEOUT)
+            except (http.Timeout, http.ConnectionError) as e:
+                reason = str(e)
+                failures += 1
+            else:
+                if response.status_code == 429:
+                    reason = 'HTTP 429'
+                    throttles += 1
+                    retry_after = response.headers.get('Retry-After', '')
+                elif response.status_code >= 500:
+                    reason = 'HTTP {0}'.format(response.status_code)
+                    failures += 1
+                else:
+                    try:
+                        return response.json()['results']['bindings']
+                    except (json.decoder.JSONDecodeError, KeyError):
+                        raise SparqlError('JSON Error: {0} {1} {2}'.format(
+                            self.endpoint, parameters, response.text))
+            if failures > retries or throttles > self.retries:
+                raise SparqlError(reason)
+            delay = SPARQL_BACKOFF * 2 ** (failures + throttles - 1) * random.uniform(0.5, 1.5)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            warning('SPARQL query failed ({0}), retrying in {1:.1f}s', reason, delay)
+            time.sleep(delay)
+
+    def _timed_query(self, query, retries=None):
+        '''Execute a query and returns a `(results, cached, latency)` tuple'''
+        started = time.monotonic()
+        results, cached = self._cached_query(query, retries)
+        return results, cached, time.monotonic() - started
+
+    def map_chunks(self, items, build, batcher):
+        '''
+        Query items by chunks sized by an `AdaptiveBatcher`.
+
+        `build(chunk)` builds the query of a chunk of items.
+        Chunks are executed concurrently and `(chunk, results)` tuples
+        are yielded as soon as each query completes.
+        A failed chunk is split in halves which are queried again
+        so no item is lost unless a single one keeps failing.
+        A chunk missing from a readonly responses cache is not split.
+        '''
+        items = iter(items)
+        retry = deque()
+        running = {}
+        offset = 0
+        exhausted = False
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            while True:
+                while len(running) < self.concurrency and (retry or not exhausted):
+                    if retry:
+                        start, chunk = retry.popleft()
+                    else:
+                        start, chunk = offset, tuple(islice(items, batcher.next_size()))
+                        offset += len(chunk)
+                    if not chunk:
+                        exhausted = True
+                        continue
+                    # Only single items are retried as is
+                    retries = None if len(chunk) == 1 else 0
+                    running[pool.submit(self._timed_query, build(chunk), retries)] = start, chunk
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    start, chunk = running.pop(future)
+                    try:
+                        results, cached, latency = future.result()
+                    except CacheMiss as e:
+                        batcher.record(start, len(chunk))
+                        error('SPARQL query of {0} items failed: {1}', len(chunk), e)
+                        continue
+                    except SparqlError as e:
+                        if len(chunk) > 1:
+                            batcher.failure()
+                            half = len(chunk) // 2
+                            warning('SPARQL query of {0} items failed ({1}), retrying by halves',
+                                    len(chunk), e)
+                            retry.extend(((start, chunk[:half]), (start + half, chunk[half:])))
+                        else:
+                            error('SPARQL query failed for {0}: {1}', chunk[0], e)
+                        continue
+                    batcher.record(start, len(chunk))
+                    if not cached:
+                        batcher.success(latency)
+                    yield chunk, results
+        batcher.save()
+
+
+_client = None
+_cache = None
+_home = None
+_dump = None
+# Parameters of the shared client and dump, to be applied again in worker processes
+_config = {}
+
+
+def sparql_client():
+    '''Get the shared SPARQL client'''
+    global _client
+    if _client is None:
+        _client = SparqlClient(cache=_cache)
+    return _client
+
+
+def configure_sparql_cache(home, mode=caching.ON, ttl=caching.CACHE_TTL):
+    '''Configure the shared SPARQL client responses cache stored into `home`'''
+    global _client, _cache, _home
+    filename = os.path.join(home, caching.CACHE_DIR, 'sparql.sqlite')
+    _cache = None if mode == caching.OFF else caching.ResponseCache(filename, mode, ttl)
+    _client = None
+    _home = home
+    _config.update(home=home, mode=mode, ttl=ttl)
+
+
+def sparql_batcher(name, size):
+    '''
+    Get an `AdaptiveBatcher` starting with `size` items by chunk
+    unless a size has been learned by a previous run.
+
+    When cached responses can be used, chunks first follow the previous run layout
+    so queries match the cached ones from one run to another.
+    '''
+    replay = _cache is not None and _cache.mode in (caching.ON, caching.READONLY)
+    state = None
+    if _home:
+        dirname = os.path.join(_home, caching.CACHE_DIR)
+        os.makedirs(dirname, exist_ok=True)
+        state = os.path.join(dirname, 'sparql-chunks.json')
+    return AdaptiveBatcher(name, size, state=state, replay=replay)
+
+
+def configure_wikidata_dump(filename, workers=None):
+    '''Extract Wikidata metadata from a dump (or a subset) instead of the SPARQL endpoint'''
+    global _dump
+    if _dump is not None and _dump.filename == filename:
+        return  # Keep the already loaded entities
+    _dump = wikidump.WikidataDump(filename, workers) if filename else None
+    _config.update(dump=filename, workers=workers)
+
+
+def configuration():
+    '''
+    Get the parameters given to `configure_sparql_cache()` and `configure_wikidata_dump()`
+    so they can be applied by `configure()` in worker processes,
+    whatever their start method.
+    '''
+    return dict(_config)
+
+
+def configure(config):
+    '''Apply a `configuration()`'''
+    if 'home' in config:
+        configure_sparql_cache(config['home'], config['mode'], config['ttl'])
+    if 'dump' in config:
+        configure_wikidata_dump(config['dump'], config['workers'])
+
+
+def data_query(query, selection, values=None):
+    '''
+    Execute a SPARQL query and returns its reduced rows (see `data_reduce_result()`).
+
+    When a Wikidata dump is configured, rows are extracted from it
+    using the query `selection` counterpart, restricted to some `values`
+    (see `WikidataDump.select()`).
+    '''
+    if _dump is not None:
+        return list(_dump.select(selection, values))
+    return data_reduce_result(data_sparql_query(query), selection.group, *selection.aggs)
+
+
+def map_data_chunks(items, build, selection, name, size):
+    '''
+    Query items by chunks and yield the reduced rows of each chunk.
+
+    `build(chunk)` builds the query of a chunk of items
+    and chunks are sized by the `name` adaptive batcher (see `SparqlClient.map_chunks()`).
+    When a Wikidata dump is configured, all items are selected at once from it.
+    '''
+    if _dump is not None:
+        yield list(_dump.select(selection, list(items)))
+        return
+    batcher = sparql_batcher(name, size)
+    for _, results in sparql_client().map_chunks(items, build, batcher):
+        yield data_reduce_result(results, selection.group, *selection.aggs)
+
+
 def data_sparql_query(query, graph='http://fr.dbpedia.org'):
     '''
     Execute a SPARQL query and returns a list of n-uplets.
     '''
-    headers = {
-        'User-Agent': 'geozones/1.0 (http://github.com/etalab/geozones)',
-        'Accept': 'application/sparql-results+json',
-    }
-    parameters = {
-        # 'default-graph-uri': graph,
-        'query': query,
-        'format': 'json'
-    }
-
-    try:
-        response = http.post(WIKIDATA_SPARQL, data=parameters, headers=headers)
-    except http.ReadTimeout:
-        error('Timeout:', WIKIDATA_SPARQL, parameters)
-        return []
-    try:
-        data = response.json()
-    except json.decoder.JSONDecodeError:
-        error('JSON Error: {0} {1} {2}',
-              WIKIDATA_SPARQL, parameters, response.text)
-        return []
-    # print('data', data_reduce_result())
-    return data['results']['bindings']
+    return sparql_client().query(query)
 
 
 def data_reduce_result(data, key, *aggs):
@@ -0,0 +1,332 @@
+'''
+Wikidata JSON dumps helpers
+
+Wikidata metadata can be extracted from a local JSON dump
+(ex: `latest-all.json.bz2`) instead of the SPARQL endpoint.
+Each SPARQL query has a `Selection` counterpart describing
+the entities and properties it retrieves, so rows produced from a dump
+have the same shape as the `wiki.data_reduce_result()` ones.
+
+Full dumps are huge: they should first be filtered by `build_subset()`
+into a small JSON lines subset only containing the entities and properties used by selections.
+'''
+import bz2
+import gzip
+import io
+import json
+import re
+import shutil
+import subprocess
+
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+from .tools import chunker, info, success, warning
+
+WD = 'http://www.wikidata.org/entity/'
+COMMONS = 'http://commons.wikimedia.org/wiki/Special:FilePath/'
+
+INSTANCE_OF = 'P31'
+END_TIME = 'P582'
+# Sitelinks kept into subsets
+SITES = ('frwiki', 'enwiki')
+# Number of dump lines parsed at once by a worker process
+PARSE_CHUNK_SIZE = 2000
+# Multi-threaded bzip2 decompressors, used when available
+BZIP2_TOOLS = ('lbzip2', 'pbzip2')
+# Subsets are stored as JSON lines
+SUBSET_EXTENSIONS = ('.jsonl', '.jsonl.gz')
+
+RE_ENTITY_ID = re.compile(r'"id"\s*:\s*"([QP]\d+)"')
+
+# All declared selections
+SELECTIONS = []
+
+
+class Selection(object):
+    '''
+    Describe the entities and properties retrieved by a SPARQL query.
+
+    - `key` is the name of the entity URI column
+    - `group` is the column SPARQL results are reduced by (`key` by default)
+    - `match` is a `(name, property)` tuple of the identifying property
+      (ex: `('insee', 'P374')`) or `None` for entities selected by identifiers
+    - `instance_of` restricts entities to some classes (`P31`)
+    - `fields` maps columns names to properties
+    - `aggs` are the columns aggregated as lists
+    - `required` are the columns an entity must have to be selected
+    - `current` are the columns ignoring ended statements (with a `P582` qualifier)
+    - `filters` maps columns names to a predicate on their values
+    - `wikipedia` is the site of the `wikipedia` column (ex: `frwiki`)
+    '''
+    def __init__(self, key, match=None, instance_of=None, fields=None, aggs=(), required=(),
+                 current=(), filters=None, wikipedia=None, group=None):
+        self.key = key
+        self.group = group or key
+        self.match = match
+        self.instance_of = instance_of
+        self.fields = fields or {}
+        self.aggs = aggs
+        self.required = required
+        self.current = current
+        self.filters = filters or {}
+        self.wikipedia = wikipedia
+        SELECTIONS.append(self)
+
+    @property
+    def properties(self):
+        '''All the properties used by this selection'''
+        properties = set(self.fields.values())
+        if self.match:
+            properties.add(self.match[1])
+        if self.instance_of:
+            properties.add(INSTANCE_OF)
+        return properties
+
+    def row(self, entity, value=None):
+        '''Build a row from an entity or `None` if it does not match'''
+        claims = entity.get('claims', {})
+        if self.instance_of:
+            classes = set(statements_values(claims.get(INSTANCE_OF, [])))
+            if not classes & set(WD + qid for qid in self.instance_of):
+                return None
+        row = {self.key: WD + entity['id']}
+        if self.match:
+            row[self.match[0]] = value
+        for name, prop in self.fields.items():
+            keep = self.filters.get(name)
+            values = [
+                v for v in statements_values(claims.get(prop, []), name in self.current)
+                if keep is None or keep(v)
+            ]
+            if name in self.aggs:
+                row[name] = list(dict.fromkeys(values))
+            elif values:
+                row[name] = values[0]
+        if self.wikipedia:
+            title = entity.get('sitelinks', {}).get(self.wikipedia, {}).get('title')
+            if title:
+                row['wikipedia'] = wikipedia_url(self.wikipedia, title)
+        if any(name not in row for name in self.required):
+            return None
+        return row
+
+
+def wikipedia_url(site, title):
+    '''Build a Wikipedia article URL the way the SPARQL endpoint does'''
+    language = site[:-len('wiki')]
+    return 'https://{0}.wikipedia.org/wiki/{1}'.format(language, quote(title.replace(' ', '_')))
+
+
+def snak_value(snak):
+    '''Get a snak value as the SPARQL endpoint would serialize it'''
+    if snak.get('snaktype') != 'value':
+        return None
+    datavalue = snak['datavalue']
+    value = datavalue['value']
+    if datavalue['type'] == 'wikibase-entityid':
+        return WD + value['id']
+    elif datavalue['type'] == 'quantity':
+        return value['amount'].lstrip('+')
+    elif datavalue['type'] == 'monolingualtext':
+        return value['text']
+    elif datavalue['type'] == 'time':
+        return value['time'].lstrip('+')
+    elif snak.get('datatype') == 'commonsMedia':
+        return COMMONS + quote(value)
+    elif isinstance(value, str):
+        return value
+    return None
+
+
+def statements_values(statements, current=False):
+    '''
+    Get the values of the best ranked statements (SPARQL `wdt:` truthy values).
+
+    With `current`, ended statements are ignored.
+    '''
+    statements = [s for s in statements if s.get('rank') != 'deprecated']
+    if current:
+        statements = [s for s in statements if END_TIME not in s.get('qualifiers', {})]
+    preferred = [s for s in statements if s.get('rank') == 'preferred']
+    for statement in preferred or statements:
+        value = snak_value(statement['mainsnak'])
+        if value is not None:
+            yield value
+
+
+def _open(filename, workers=None):
+    '''Open a plain, gzipped or bzipped dump as a text stream'''
+    if filename.endswith('.bz2'):
+        tool = next((tool for tool in BZIP2_TOOLS if shutil.which(tool)), None)
+        if tool:
+            # Decompress with multiple threads in a separate process
+            args = [tool, '-dc', filename]
+            if workers:
+                args.insert(1, '-n{0}'.format(workers) if tool == 'lbzip2' else '-p{0}'.format(workers))
+            process = subprocess.Popen(args, stdout=subprocess.PIPE)
+            return io.TextIOWrapper(process.stdout, encoding='utf-8')
+        return bz2.open(filename, 'rt', encoding='utf-8')
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename, encoding='utf-8')
+
+
+def strip_entity(entity, properties):
+    '''Only keep the given properties and the main sitelinks of an entity'''
+    claims = entity.get('claims', {})
+    return {
+        'id': entity['id'],
+        'sitelinks': dict(
+            (k, {'title': v['title']}) for k, v in entity.get('sitelinks', {}).items() if k in SITES
+        ),
+        'claims': dict((prop, [{
+            'mainsnak': s['mainsnak'],
+            'rank': s.get('rank'),
+            'qualifiers': dict((q, True) for q in s.get('qualifiers', {}) if q == END_TIME),
+        } for s in statements]) for prop, statements in claims.items() if prop in properties),
+    }
+
+
+def parse_lines(lines, keys=None, properties=None, ids=None):
+    '''
+    Parse some dump lines and return the matching stripped entities.
+
+    An entity matches if it has one of the `keys` properties or if its identifier is in `ids`.
+    Without `keys` nor `ids`, all entities match.
+    Executed in worker processes.
+    '''
+    entities = []
+    markers = ['"{0}"'.format(key) for key in keys or []]
+    for line in lines:
+        line = line.strip().rstrip(',')
+        if not line or line in ('[', ']'):
+            continue
+        if keys or ids:
+            # Cheap textual check before a full JSON parsing
+            m = RE_ENTITY_ID.search(line)
+            if not (ids and m and m.group(1) in ids) and not any(marker in line for marker in markers):
+                continue
+        entity = json.loads(line)
+        claims = entity.get('claims', {})
+        if (keys or ids) and entity['id'] not in (ids or ()) and not any(key in claims for key in keys or ()):
+            continue
+        entities.append(strip_entity(entity, properties) if properties else entity)
+    return entities
+
+
+def iter_entities(filename, keys=None, properties=None, ids=None, workers=None):
+    '''
+    Stream the matching entities of a dump (see `parse_lines()`).
+
+    With `workers`, lines are parsed by chunks into a pool of `workers` processes
+    (and bzip2 dumps are decompressed with multiple threads if `lbzip2` or `pbzip2` is available).
+    '''
+    with _open(filename, workers) as lines:
+        if not workers:
+            for chunk in chunker(lines, PARSE_CHUNK_SIZE):
+                yield from parse_lines(chunk, keys, properties, ids)
+            return
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque()
+            for chunk in chunker(lines, PARSE_CHUNK_SIZE):
+                pending.append(pool.submit(parse_lines, chunk, keys, properties, ids))
+                # Bound the number of chunks in memory
+                if len(pending) > 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+
+def selections_properties():
+    '''The `(keys, properties)` used by all declared selections'''
+    keys = set(selection.match[1] for selection in SELECTIONS if selection.match)
+    properties = set(prop for selection in SELECTIONS for prop in selection.properties)
+    return keys, properties
+
+
+def build_subset(dump, output, ids=None, workers=None):
+    '''
+    Filter a dump into a gzipped JSON lines subset only containing
+    the entities having the identifying property of a selection
+    or whose identifier is in `ids`, stripped to the properties used by selections.
+
+    Returns the number of entities in the subset.
+    '''
+    keys, properties = selections_properties()
+    count = 0
+    with gzip.open(output, 'wt', encoding='utf-8') as out:
+        for entity in iter_entities(dump, keys, properties, set(ids or []), workers):
+            out.write(json.dumps(entity, separators=(',', ':')))
+            out.write('\n')
+            count += 1
+    return count
+
+
+class WikidataDump(object):
+    '''
+    An in-memory index of a dump (or a subset) entities.
+
+    All the entities of a subset are kept whereas only the ones
+    having the identifying property of a selection are kept from a full dump.
+    Entities are indexed by their identifier and by their identifying property values.
+    '''
+    def __init__(self, filename, workers=None):
+        self.filename = filename
+        self.workers = workers
+        self._entities = None
+        self._index = None
+
+    @property
+    def is_subset(self):
+        return self.filename.endswith(SUBSET_EXTENSIONS)
+
+    def load(self):
+        keys, properties = selections_properties()
+        info('Loading Wikidata entities from {0}', self.filename)
+        self._entities = {}
+        self._index = defaultdict(lambda: defaultdict(list))
+        if self.is_subset:
+            entities = iter_entities(self.filename, workers=self.workers)
+        else:
+            entities = iter_entities(self.filename, keys, properties, workers=self.workers)
+        for entity in entities:
+            self._entities[entity['id']] = entity
+            for key in keys:
+                for value in statements_values(entity['claims'].get(key, [])):
+                    self._index[key][value.lower()].append(entity['id'])
+        success('Loaded {0} Wikidata entities', len(self._entities))
+
+    def select(self, selection, values=None):
+        '''
+        Iterate over the rows of a selection.
+
+        `values` restricts the identifying property values
+        (or the entities identifiers if the selection has no `match`).
+        '''
+        if self._entities is None:
+            self.load()
+        if selection.match is None:
+            for qid in values or []:
+                entity = self._entities.get(qid)
+                if entity is None:
+                    hint = '' if self.is_subset else ' (full dumps should be filtered into a subset first)'
+                    warning('Entity {0} not found in {1}{2}', qid, self.filename, hint)
+                    continue
+                row = selection.row(entity)
+                if row:
+                    yield row
+            return
+        name, prop = selection.match
+        index = self._index[prop]
+        values = list(index) if values is None else [value.lower() for value in values]
+        for value in values:
+            for qid in index.get(value, []):
+                entity = self._entities[qid]
+                for original in statements_values(entity['claims'][prop], name in selection.current):
+                    if original.lower() != value:
+                        continue
+                    row = selection.row(entity, original)
+                    if row:
+                        yield row
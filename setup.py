@@ -9,7 +9,7 @@ setup(
     install_requires=[
         'Fiona==1.8.13',
         'Flask==1.0.2',
-        'Shapely==1.6.4.post2',
+        'Shapely==2.0.2',
         'click==7.0',
         'colorama==0.4.1',
         'colorhash==1.0.2',
@@ -18,7 +18,10 @@ setup(
         'requests==2.21.0',
     ],
     extras_require={
-        'i18n': ['Babel==2.6.0']
+        'i18n': ['Babel==2.6.0'],
+        'arrow': ['pyogrio==0.8.0', 'pyarrow==14.0.1'],
+        'logos': ['Pillow==10.1.0', 'CairoSVG==2.7.1'],
+        'test': ['pytest==4.6.3', 'mongomock==3.17.0'],
     },
     entry_points='''
         [console_scripts]
@@ -0,0 +1,69 @@
+import pytest
+
+from geozones import geometry
+
+SQUARE = {'type': 'Polygon', 'coordinates': [[(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]]}
+NEIGHBOUR = {'type': 'Polygon', 'coordinates': [[(1, 0), (2, 0), (2, 1), (1, 1), (1, 0)]]}
+LINE = {'type': 'LineString', 'coordinates': [(0, 0), (1, 1)]}
+
+
+def test_prepare_fiona_geometries_vectorized(monkeypatch):
+    # Fiona 1.9+ features geometries are not mappings anymore
+    Geometry = pytest.importorskip('fiona.model').Geometry
+
+    def one_by_one(*args):
+        raise AssertionError('Geometries should be prepared at once')
+    monkeypatch.setattr(geometry, 'prepare_geometry', one_by_one)
+
+    prepared = geometry.prepare_geometries([Geometry.from_dict(SQUARE), SQUARE])
+
+    assert [geom_type for geom_type, _, _ in prepared] == ['Polygon', 'Polygon']
+    assert all(geom['type'] == 'MultiPolygon' for _, geom, _ in prepared)
+
+
+def test_prepare_geometries_isolate_failures():
+    prepared = geometry.prepare_geometries([SQUARE, None])
+
+    assert prepared[0][0] == 'Polygon'
+    assert isinstance(prepared[1], str)
+
+
+def test_to_multipolygons():
+    geoms = geometry.to_multipolygons([SQUARE, NEIGHBOUR])
+
+    assert [geom.geom_type for geom in geoms] == ['MultiPolygon', 'MultiPolygon']
+
+
+def test_to_multipolygons_unsupported_type():
+    with pytest.raises(ValueError, match='LineString'):
+        geometry.to_multipolygons([SQUARE, LINE])
+
+
+def test_geometry_hashes_from_wkb():
+    geoms = geometry.to_multipolygons([SQUARE, NEIGHBOUR])
+
+    hashes = geometry.geometry_hashes(geometry.geometry_array([g.wkb for g in geoms]))
+
+    assert hashes == geometry.geometry_hashes(geoms)
+    assert len(set(hashes)) == 2
+
+
+def test_iter_prepared_by_vectorized_chunks():
+    features = [{'geometry': SQUARE}, {'geometry': LINE}]
+
+    prepared = [p for _, p in geometry.iter_prepared(features, simplify=0.1)]
+
+    assert prepared[0][1]['type'] == 'MultiPolygon'
+    assert prepared[1] == ('LineString', None, None)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_union_geometries_on_grid(workers):
+    shifted = dict(NEIGHBOUR, coordinates=[[(x + 1e-7, y) for x, y in NEIGHBOUR['coordinates'][0]]])
+    geoms = geometry.to_multipolygons([SQUARE, shifted, SQUARE])
+
+    aggregated = geometry.union_geometries(geoms, workers=workers, grid_size=1e-3, chunk_size=1)
+
+    assert aggregated.geom_type == 'MultiPolygon'
+    assert len(aggregated.geoms) == 1
+    assert aggregated.area == pytest.approx(2)
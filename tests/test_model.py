@@ -0,0 +1,66 @@
+import json
+
+from functools import partial
+
+import mongomock
+import pytest
+
+from geozones import model
+from geozones.db import BulkWriter, Manifest
+from geozones.model import Level
+
+FEATURES = [
+    {
+        'type': 'Feature',
+        'properties': {'code': str(i), 'start': '2019-01-01' if i % 2 else None},
+        'geometry': {'type': 'Polygon', 'coordinates': [[[i, 0], [i + 1, 0], [i + 1, 1], [i, 0]]]},
+    }
+    for i in range(6)
+]
+
+
+@pytest.fixture
+def db():
+    client = mongomock.MongoClient()
+    collection = client.geozones.geozones
+    collection.bulk_writer = partial(BulkWriter, collection)
+    collection.manifest = Manifest(client.geozones.manifest)
+    return collection
+
+
+@pytest.fixture
+def level(tmpdir, monkeypatch):
+    # Save a checkpoint after each feature
+    monkeypatch.setattr(model, 'CHECKPOINT_SIZE', 1)
+    level = Level('test', 'Test', 10)
+
+    @level.extractor('http://somewhere/zones.json')
+    def extract_zones(db, polygon):
+        props = polygon['properties']
+        zone = {'code': props['code'], 'name': props['code']}
+        if props['start']:
+            zone['validity'] = {'start': props['start']}
+        return zone
+
+    with open(tmpdir.mkdir('test').join('zones.json').strpath, 'w') as out:
+        json.dump(FEATURES, out)
+    return level
+
+
+def test_load_validity_dated_zones(level, db, tmpdir):
+    assert level.load(tmpdir.strpath, db, exclude=[]) == len(FEATURES)
+    assert db.count_documents({}) == len(FEATURES)
+    assert db.find_one({'_id': 'test:1@2019-01-01'})['code'] == '1'
+    assert db.find_one({'_id': 'test:2'})['code'] == '2'
+
+
+def test_resume_load_validity_dated_zones(level, db, tmpdir):
+    path = tmpdir.join('test', 'zones.json').strpath
+    extractor = level.extractors[0][1]
+    fingerprint = level.fingerprint(path, extractor)
+    # Simulate a load interrupted after the 3 first features
+    db.manifest.checkpoint(level.id, 'extract_zones', 'test/zones.json', fingerprint, 3, 3)
+
+    assert level.load(tmpdir.strpath, db, exclude=[], resume=True) == len(FEATURES)
+    assert sorted(db.distinct('code')) == ['3', '4', '5']
+    assert db.find_one({'_id': 'test:5@2019-01-01'})['code'] == '5'
@@ -0,0 +1,59 @@
+from functools import partial
+
+import mongomock
+import pytest
+
+from geozones.db import BulkWriter
+from geozones.model import Level
+from geozones.rollup import compute_rollups, ROLLUPS_FIELD
+
+
+@pytest.fixture
+def db():
+    collection = mongomock.MongoClient().geozones.geozones
+    collection.bulk_writer = partial(BulkWriter, collection)
+    collection.insert_many([
+        {'_id': 'county:computed', 'level': 'county'},
+        {'_id': 'county:provided', 'level': 'county', 'population': 7},
+        {'_id': 'town:1', 'level': 'town', 'parents': ['county:computed', 'county:provided'], 'population': 1},
+        {'_id': 'town:2', 'level': 'town', 'parents': ['county:computed', 'county:provided'], 'population': 2},
+    ])
+    return collection
+
+
+@pytest.fixture
+def levels():
+    town, county = Level('town', 'Town', 20), Level('county', 'County', 10)
+    county.rollup(town, 'population', fallback=True)
+    return [county]
+
+
+def population(db, zone_id):
+    return db.find_one({'_id': zone_id})['population']
+
+
+def test_fallback_rollup_keeps_provided_values(db, levels):
+    compute_rollups(db, levels)
+
+    assert population(db, 'county:computed') == 3
+    assert population(db, 'county:provided') == 7
+
+
+def test_fallback_rollup_refreshes_computed_values(db, levels):
+    compute_rollups(db, levels)
+    db.update_one({'_id': 'town:1'}, {'$set': {'population': 10}})
+
+    compute_rollups(db, levels)
+
+    assert population(db, 'county:computed') == 12
+    assert population(db, 'county:provided') == 7
+
+
+def test_fallback_rollup_keeps_values_provided_after_computation(db, levels):
+    compute_rollups(db, levels)
+    db.update_one({'_id': 'county:computed'},
+                  {'$set': {'population': 100}, '$pull': {ROLLUPS_FIELD: {'$in': ['population']}}})
+
+    compute_rollups(db, levels)
+
+    assert population(db, 'county:computed') == 100
@@ -0,0 +1,49 @@
+import pytest
+
+from geozones import cache as caching
+from geozones import wiki
+
+ITEMS = list(range(100))
+
+
+@pytest.fixture
+def home(tmpdir, monkeypatch):
+    def query(client, query, retries=None):
+        if query.count(' ') > 30:
+            raise wiki.SparqlError('HTTP 500')
+        return [{'item': {'value': item}} for item in query.split()]
+    monkeypatch.setattr(wiki.SparqlClient, '_query', query)
+    yield str(tmpdir)
+    wiki.configure_sparql_cache(str(tmpdir), caching.OFF)
+
+
+def query_items(home, mode):
+    wiki.configure_sparql_cache(home, mode)
+    batcher = wiki.sparql_batcher('items', 10)
+    chunks = wiki.sparql_client().map_chunks(ITEMS, lambda chunk: ' '.join(map(str, chunk)), batcher)
+    return batcher, sorted(int(row['item']['value']) for _, rows in chunks for row in rows)
+
+
+def test_chunks_adapt_with_cache(home):
+    batcher, items = query_items(home, caching.ON)
+
+    assert items == ITEMS
+    assert batcher.size > 10
+
+
+def test_readonly_cache_replays_chunks(home):
+    first, _ = query_items(home, caching.ON)
+    # Only replayed chunks can match the cached queries
+    replay, items = query_items(home, caching.READONLY)
+
+    assert items == ITEMS
+    assert replay.chunks == first.chunks
+
+
+def test_readonly_cache_miss_is_not_split(home, monkeypatch):
+    monkeypatch.setattr(wiki.SparqlClient, '_query', None)
+
+    batcher, items = query_items(home, caching.READONLY)
+
+    assert items == []
+    assert batcher.chunks == {0: 10, 10: 10, 20: 10, 30: 10, 40: 10, 50: 10, 60: 10, 70: 10, 80: 10, 90: 10}